@@ -1,4 +1,5 @@
 import datetime
+import hashlib
 from itertools import zip_longest
 import os
 import sys
@@ -11,8 +12,11 @@ import time
  
 from lib.dataset_loader import load_multiple_from_file
 from lib.config import get_config
+from lib.planner import plan_benchmark, format_plan, get_step_name
 from methods.abstract_methods.experiment import Experiment
 from methods.abstract_methods.supervised_experiment import SupervisedExperiment
+from methods.model_pool import MODEL_POOL
+from methods.checkpoint import JobCheckpoint, DEFAULT_CHECKPOINT_INTERVAL
 from results_analysis import run_full_analysis, list_available_analysis_methods
 
 
@@ -49,6 +53,9 @@ def main():
         print_w_sep_line("Finish", config["global"]["interactive"])
         exit(0)
 
+    if config["global"]["resume"] is not None:
+        config = load_resumed_config(config["global"]["resume"])
+
     if config["global"]["name"] is not None:
         global LOG_PATH
         LOG_PATH = os.path.join(RESULTS_PATH, "logs", config["global"]["name"])
@@ -56,7 +63,14 @@ def main():
     print_w_sep_line(f"Loading datasets {[dataset['filepath'] for dataset in config['data']['list']]}...", config["global"]["interactive"])
     dataset_dict = load_multiple_from_file(datasets_params=config["data"]["list"], is_interactive=config["global"]["interactive"])
 
+    if config["global"]["plan"]:
+        print_w_sep_line("Execution plan:\n", config["global"]["interactive"])
+        print(format_plan(plan_benchmark(list(dataset_dict.keys()), config["methods"]["list"], scan_for_detection_methods())))
+        print_w_sep_line("Finish", config["global"]["interactive"])
+        exit(0)
+
     print_w_sep_line("Running benchmark...", config["global"]["interactive"])
+    save_config(config)
     benchmark_results = run_benchmark(dataset_dict, config)
 
     print_w_sep_line("Saving experiment results\n", config["global"]["interactive"])
@@ -71,55 +85,156 @@ def main():
 def run_benchmark(dataset_dict, config):
     
     available_experiments = scan_for_detection_methods()    
-    outputs = dict()
+    plan = plan_benchmark(list(dataset_dict.keys()), config["methods"]["list"], available_experiments)
+    print(f"Execution plan:\n{format_plan(plan)}")
+    results = {}
+    # results and checkpoints of previous runs are only reused when resuming an interrupted run
+    resume = config["global"].get("resume") is not None
+    datasets_params = dict(zip(dataset_dict.keys(), config["data"]["list"]))
+    # identified before running any job, as experiments may modify their method config
+    job_ids = {step_idx: get_job_id((step["datasets"][0], step["method_index"], step["sub_index"]), step["method_config"], datasets_params.get(step["datasets"][0]))
+               for step_idx, step in enumerate(plan) if step["type"] == "job"}
     
-    for dataset_name, data in dataset_dict.items():
-        print_w_sep_line(f"Running experiments on {dataset_name} dataset:\n", config["global"]["interactive"])    
-        outputs[dataset_name] = {}
-            
-        for method_config in config["methods"]["list"]:
-            
-            if method_config["name"] == "all":
-                outputs[dataset_name].update(run_all_available(data, method_config, available_experiments))
+    for step_idx, step in enumerate(plan):
+        method_config = step["method_config"]
+        if step["type"] == "shared_scoring":
+            run_shared_scoring(dataset_dict, step)
+        else:
+            dataset_name = step["datasets"][0]
+            job_key = (dataset_name, step["method_index"], step["sub_index"])
+            job_id = job_ids[step_idx]
+            job_path = os.path.join(LOG_PATH, "jobs", job_id + ".json")
+            if resume and os.path.exists(job_path):
+                print(f"Skipping {get_step_name(step)} on {dataset_name} dataset, results of a previous run found at {job_path}")
+                with open(job_path, "r") as file:
+                    results[job_key] = [tuple(item) for item in json.load(file)]
                 continue
             
+            print_w_sep_line(f"Running {get_step_name(step)} on {dataset_name} dataset:\n", config["global"]["interactive"])
+            checkpoint = JobCheckpoint(os.path.join(LOG_PATH, "checkpoints", job_id + ".json"),
+                                       method_config.get("checkpoint_interval", DEFAULT_CHECKPOINT_INTERVAL), resume)
             try:
-                results = run_experiment(data, method_config, method_config["name"], available_experiments)
+                results[job_key] = run_job(dataset_dict[dataset_name], step, available_experiments, checkpoint)
+                save_job_results(job_path, results[job_key])
+                checkpoint.remove()
             except Exception:
                 print(f"Experiment {method_config['name']} failed. Skipping and continuing with the next experiment.")
                 # Print detailed error message to stderr
                 print(f"Experiment {method_config['name']} failed due to below reasons:", file=sys.stderr)
                 print(traceback.format_exc(), file=sys.stderr)
-                continue
-            
-            outputs[dataset_name][method_config["name"]] = results
+        
+        # Free pooled models that none of the remaining steps needs
+        MODEL_POOL.retain({model for remaining in plan[step_idx + 1:] for model in remaining["models"]})
+    
+    # Assemble outputs in the order given by the datasets and methods configuration
+    outputs = dict()
+    for dataset_name in dataset_dict.keys():
+        outputs[dataset_name] = {}
+        for (result_dataset_name, _, _), job_results in sorted(results.items()):
+            if result_dataset_name == dataset_name:
+                for name, result in job_results:
+                    outputs[dataset_name][name] = result
     
     return outputs
 
 
-def run_all_available(data, method_config, available_experiments):
-    results = {}
-    for experiment in available_experiments:
-        try:
-            experiment_instance = experiment(data=data, config=method_config)
-            results[experiment_instance.name] = (experiment_instance.run())
-        except Exception:
-            print(f"Experiment {method_config['name']} failed. Skipping and continuing with the next experiment.")
-            # Print detailed error message to stderr
-            print(f"Experiment {method_config['name']} failed due to below reasons:", file=sys.stderr)
-            print(traceback.format_exc(), file=sys.stderr)
-            continue
-    return results
+def run_job(data, step, available_experiments, checkpoint=None):
+    """
+    Run a single planned (method, dataset) job, return a list of (key, results) pairs.
+    An experiment may return a list of results (e.g. one for each evaluated number of perturbations), which are keyed by their names.
+    """
+    method_config = step["method_config"]
+    if method_config["name"] != "all":
+        name, results = method_config["name"], run_experiment(data, method_config, method_config["name"], available_experiments, checkpoint)
+    else:
+        experiment_instance = step["experiment"](data=data, config=method_config)
+        experiment_instance.checkpoint = checkpoint
+        name, results = experiment_instance.name, experiment_instance.run()
+    job_results = [(result["name"], result) for result in results] if isinstance(results, list) else [(name, results)]
+    for idx, (key, result) in enumerate(job_results):
+        add_throughput(result)
+        mode = get_inference_mode(result)
+        if mode != "float32":
+            # results of models run in reduced precision or compiled are kept apart from the float32 eager ones
+            result["name"] = f"{result['name']} ({mode})"
+            job_results[idx] = (f"{key} ({mode})", result)
+    return job_results
+
+
+def get_inference_mode(result):
+    """Return the description of the mode the models of a result were run in, e.g. float32, int8, "bfloat16, compiled" or onnx-int8."""
+    if result.get("inference_backend", "pytorch") != "pytorch":
+        return result["inference_backend"]
+    mode = result.get("cpu_precision", "float32")
+    if result.get("compiled", False):
+        mode += ", compiled"
+    return mode
+
 
+def add_throughput(result):
+    """Add the number of texts (of the train and test split) processed per second to the result and print it"""
+    if "running_time_seconds" not in result or "input_data" not in result:
+        return
+    n_texts = sum(len(result["input_data"][split]["text"]) for split in ("train", "test") if split in result["input_data"])
+    if n_texts == 0 or result["running_time_seconds"] <= 0:
+        return
+    result["throughput_texts_per_second"] = n_texts / result["running_time_seconds"]
+    print(f"{result['name']} ({get_inference_mode(result)}): {n_texts} texts in {result['running_time_seconds']:.2f}s, "
+          f"{result['throughput_texts_per_second']:.2f} texts/s")
 
-def run_experiment(data, method_config, method_name, available_experiments):
+
+def get_job_id(job_key, method_config, dataset_params=None):
+    """
+    Return the identifier of a job, under which its results and checkpoints are stored. It includes a hash
+    of the method config (with its model settings) and the dataset parameters, so that a resumed run
+    never reuses results computed with a different configuration.
+    """
+    dataset_name, method_index, sub_index = job_key
+    settings = json.dumps({"method": method_config, "dataset": dataset_params}, sort_keys=True, default=str)
+    settings_hash = hashlib.sha1(settings.encode("utf-8")).hexdigest()[:12]
+    return f"{dataset_name.replace('/', '-')}-{method_index}-{sub_index}-{settings_hash}"
+
+
+def save_job_results(job_path, job_results):
+    """Save results of a finished job, so that it can be skipped when resuming the benchmark run"""
+    if not os.path.exists(os.path.dirname(job_path)):
+        os.makedirs(os.path.dirname(job_path))
+    try:
+        with open(job_path + ".tmp", "w") as file:
+            json.dump(job_results, file)
+        os.replace(job_path + ".tmp", job_path)
+    except Exception:
+        print(f"Failed to save results of the finished job to {job_path}, it will be run again when resuming.", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+
+
+def run_shared_scoring(dataset_dict, step):
+    """Compute token statistics for texts of all datasets in the step in one pass (see lib/planner.py)"""
+    texts = [text for dataset_name in step["datasets"] 
+             for split in ["train", "test"] 
+             for text in dataset_dict[dataset_name][split]["text"]]
+    print(f"Computing token statistics of {step['method_config']['base_model_name']} for {len(texts)} texts from datasets {step['datasets']}")
+    try:
+        empty_data = {"train": {"text": [], "label": []}, "test": {"text": [], "label": []}}
+        step["experiment"](data=empty_data, config=step["method_config"]).fill_token_stats_archive(texts)
+    except Exception:
+        print(f"Shared scoring pass failed, the statistics will be computed by each experiment separately.")
+        print(f"Shared scoring pass failed due to below reasons:", file=sys.stderr)
+        print(traceback.format_exc(), file=sys.stderr)
+
+
+def run_experiment(data, method_config, method_name, available_experiments, checkpoint=None):
     
     available_exp_names = list(map(lambda x: x.__name__, available_experiments))
     if method_name in available_exp_names:
-        return available_experiments[available_exp_names.index(method_name)](data=data, config=method_config).run()
+        experiment = available_experiments[available_exp_names.index(method_name)](data=data, config=method_config)
+        experiment.checkpoint = checkpoint
+        return experiment.run()
     
     try:  # Check if method is model name from HuggingFace Hub for sequence classification
-        return SupervisedExperiment(data, method_name, method_name, method_config).run()
+        experiment = SupervisedExperiment(data, method_name, method_name, method_config)
+        experiment.checkpoint = checkpoint
+        return experiment.run()
     except:
         print(f"Tried to run method {method_name} as supervised. Failed due to:", file=sys.stderr)
         print(traceback.format_exc(), file=sys.stderr)
@@ -148,6 +263,27 @@ def scan_for_detection_methods():
     return exp_class_list
 
 
+def save_config(config):
+    """Save config of the benchmark run at its start, so that the run can be resumed later"""
+    if not os.path.exists(LOG_PATH):
+        os.makedirs(LOG_PATH)
+    with open(os.path.join(LOG_PATH, "config.json"), "w") as file:
+        json.dump(config, file, indent=4)
+
+
+def load_resumed_config(name):
+    """Load config of an interrupted benchmark run with the given name"""
+    config_path = os.path.join(RESULTS_PATH, "logs", name, "config.json")
+    if not os.path.exists(config_path):
+        raise ValueError(f"Cannot resume benchmark run {name}, its config was not found at {config_path}")
+    print(f"Resuming benchmark run {name}")
+    with open(config_path, "r") as file:
+        config = json.load(file)
+    config["global"]["name"] = name
+    config["global"]["resume"] = name
+    return config
+
+
 def log_whole_experiment(config, outputs):
     """Log all experiment data as a whole by current time"""
         
@@ -178,6 +314,8 @@ def save_method_dataset_combination_results(methods_config, outputs):
             dataset_name = dataset_name.replace("/", "-")
             if is_all:
                 method_config = methods_config[0]
+            # a method may produce several results, each of them carries its own config
+            method_config = method_results.get("config", method_config)
             SAVE_PATH =  os.path.join(LOG_METHOD_W_DATASET_PATH, method_name, dataset_name)
             print(f"Saving results from {method_name}" 
                    f" on {dataset_name} dataset to absolute path: {os.path.abspath(SAVE_PATH)}")
@@ -27,7 +27,10 @@ YAML_CONFIG_DEFAULT_FILEPATH = "lib/default_config.yaml"
 def get_config():
     cmd_args = _parse_cmd_args()
     if cmd_args["from_config"] is not None:
-        return _from_yaml_config(cmd_args["from_config"])
+        config = _from_yaml_config(cmd_args["from_config"])
+        if cmd_args["resume"] is not None:
+            config["global"]["resume"] = cmd_args["resume"]
+        return config
     return _transform_cmd_args_to_common(cmd_args)
 
 
@@ -39,6 +42,9 @@ def _parse_cmd_args():
                         help="Set a custom name for the results log save file.")
     parser.add_argument('--from_config', type=str, default=None,
                         help="Specify filepath to YAML config file from which to read all parameters instead of the command-line arguments")
+    parser.add_argument('--resume', type=str, default=None,
+                        help="Resume an interrupted benchmark run with the given name (name of its directory in results/logs). "
+                             "Finished jobs are skipped and unfinished ones continue from their last checkpoint.")
     # Parameters for dataset loading/parsing
     parser.add_argument('--dataset', nargs='+', action=_DatasetAppendAction, type=str, default=[(DEFAULT_DATASET_FILEPATH,
                                                                                                  DEFAULT_DATASET_FILETYPE,
@@ -72,17 +78,48 @@ def _parse_cmd_args():
                         help="Specify a classification algorithm to be used for threshold computation.")
 
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_batch_tokens', type=int, default=None,
+                        help="Token budget (including padding) of length-sorted batches of supervised inference, by default batch_size * 512.")
     parser.add_argument('--base_model_name', type=str, default="gpt2-medium")
     parser.add_argument('--mask_filling_model_name',
                         type=str, default="t5-large")
     parser.add_argument('--cache_dir', type=str, default=".cache")
+    parser.add_argument('--token_stats_archive', action='store_true',
+                        help="Store per-token statistics of the base model in the cache directory and reuse them across metric-based methods and runs.")
+    parser.add_argument('--tokenization_cache', action='store_true',
+                        help="Store token ids of the texts in the cache directory and reuse them across methods sharing a tokenizer and runs.")
     parser.add_argument('--DEVICE', type=str, default="cuda",
                         help="Define a device to run the computations on (e.g. cuda, cpu...).")
+    parser.add_argument('--model_pool', action='store_true',
+                        help="Keep loaded models resident and share them between experiments.")
+    parser.add_argument('--model_pool_memory_gb', type=float, default=8,
+                        help="Memory budget of the model pool, least recently used models are evicted beyond it.")
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help="Number of processes scoring the texts in parallel on CPU (1 disables the data-parallel execution).")
+    parser.add_argument('--threads_per_worker', type=int, default=None,
+                        help="Number of torch threads of each scoring process, by default the CPU cores are split evenly among the processes.")
+    parser.add_argument('--cpu_precision', type=str, default="float32", choices=["float32", "bfloat16", "int8"],
+                        help="Precision of models run on CPU: bfloat16 (on CPUs with native support) or int8 dynamic quantization of linear layers.")
+    parser.add_argument('--compiled', action='store_true',
+                        help="Run the scoring models compiled with torch.compile (SDPA attention, inference mode), falling back to eager execution on failure.")
+    parser.add_argument('--compile_length_buckets', nargs='+', type=int, default=[32, 64, 128, 256, 512],
+                        help="Sequence lengths the inputs of compiled models are padded to, so that the models are compiled only once per bucket.")
+    parser.add_argument('--inference_backend', type=str, default="pytorch", choices=["pytorch", "onnx"],
+                        help="Backend of the supervised detectors and per-language experts, onnx runs them exported to ONNX by ONNX Runtime on CPU.")
+    parser.add_argument('--onnx_quantize', action='store_true',
+                        help="Quantize the linear layers of the exported ONNX models to int8.")
+    parser.add_argument('--onnx_parity_texts', type=int, default=16,
+                        help="Number of train texts the outputs of the ONNX and PyTorch models are compared on before the ONNX model is used.")
+    parser.add_argument('--onnx_parity_tolerance', type=float, default=0.01,
+                        help="Maximal difference of the probabilities of the ONNX and PyTorch models, otherwise the PyTorch model is used.")
 
     # Parameters for DetectGPT detection method
     parser.add_argument('--pct_words_masked', type=float, default=0.3)
     parser.add_argument('--span_length', type=int, default=2)
     parser.add_argument('--n_perturbations', type=int, default=10)
+    parser.add_argument('--n_perturbation_list', nargs='+', type=int, default=None,
+                        help="Evaluate perturbation-based methods with each of the given numbers of perturbations (overrides n_perturbations). "
+                             "Only the largest number is generated, the others are evaluated on its first perturbations, each with its own results entry.")
     parser.add_argument('--n_perturbation_rounds', type=int, default=1)
     parser.add_argument('--chunk_size', type=int, default=20)
     parser.add_argument('--n_similarity_samples', type=int, default=20)
@@ -96,12 +133,29 @@ def _parse_cmd_args():
     parser.add_argument('--mask_top_p', type=float, default=1.0)
     parser.add_argument('--random_fills', action='store_true')
     parser.add_argument('--random_fills_tokens', action='store_true')
+    parser.add_argument('--perturbation_store', action='store_true',
+                        help="Store perturbed texts in the cache directory and reuse them across perturbation-based methods and runs.")
+    parser.add_argument('--adaptive_perturbations', action='store_true',
+                        help="Perturb test texts in increments and stop once their score is confidently on one side of the calibrated threshold (at most n_perturbations).")
+    parser.add_argument('--adaptive_increment', type=int, default=3)
+    parser.add_argument('--adaptive_confidence', type=float, default=0.95)
+    parser.add_argument('--phased', action='store_true',
+                        help="Never keep the mask filling model and the base model loaded together: generate and store all perturbations first, then free the mask filling model and score them. Adaptive perturbations and pipelining are ignored in this mode.")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Generate perturbations in a separate process while scoring the already perturbed texts (CPU only).")
+    parser.add_argument('--pipeline_queue_size', type=int, default=8)
+    parser.add_argument('--generation_threads', type=int, default=None,
+                        help="Number of torch threads of the pipelined perturbation generation.")
+    parser.add_argument('--scoring_threads', type=int, default=None,
+                        help="Number of torch threads of the pipelined scoring.")
 
     # Parameters for GPTZero detection method
     parser.add_argument('--gptzero_key', type=str, default="")
     
     parser.add_argument('--analysis_methods', nargs="*", default=["all"], type=str)
     parser.add_argument('--list_analysis_methods', action="store_true")
+    parser.add_argument('--plan', action="store_true",
+                        help="Print the execution plan (order of method and dataset jobs and the models they need) and exit.")
 
     args = parser.parse_args()
     # Hotfix for argparse issue:
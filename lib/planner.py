@@ -0,0 +1,136 @@
+import torch
+
+from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
+from methods.abstract_methods.pertubation_based_experiment import PertubationBasedExperiment
+from methods.utils import get_model_variant
+
+"""
+    This module plans the execution of a benchmark run.
+
+    It expands the methods configuration into (method, dataset) jobs and orders them, so that
+    jobs requiring the same models run one after another (and the models can be reused through the model pool).
+    Metric-based methods sharing a base model (in the same variant) and the token statistics archive get one shared scoring pass
+    over the texts of all datasets, which is run before the first of these jobs.
+
+    It adheres to the following interface:
+
+    plan_benchmark()
+        - Returns a list of steps (dictionaries) to be executed in the given order
+    format_plan()
+        - Returns a human-readable description of the plan
+"""
+
+# the ensemble is matched by name, its module cannot be imported without the language identification dependencies
+ENSEMBLE_EXPERIMENT_NAME = "PerLanguageExpertsEnsemble"
+
+def get_required_models(experiment, method_config):
+    """Return a list of (model type, model name) pairs that the method will load"""
+    if experiment is None:  # Hugging Face Hub model for sequence classification
+        return [("supervised", method_config["name"])]
+    if experiment.__name__ == ENSEMBLE_EXPERIMENT_NAME:
+        # only the experts are loaded for inference, the base model is used just for finetuning
+        return [("ensemble", filepath) for filepath in (method_config.get("per_language_models") or {}).values()]
+    if issubclass(experiment, PertubationBasedExperiment):
+        if method_config.get("random_fills", False):
+            return [("base", method_config["base_model_name"])]
+        return [("base", method_config["base_model_name"]), ("mask", method_config["mask_filling_model_name"])]
+    if issubclass(experiment, MetricBasedExperiment):
+        return [("base", method_config["base_model_name"])]
+    return []
+
+
+def uses_shared_scoring(experiment, method_config):
+    return experiment is not None and \
+           issubclass(experiment, MetricBasedExperiment) and \
+           experiment.criterion_from_token_stats is not MetricBasedExperiment.criterion_from_token_stats and \
+           method_config.get("token_stats_archive", False)
+
+
+def get_shared_scoring_group(method_config):
+    """Return the key of the token statistics archive the method reads, methods with the same key can share a scoring pass"""
+    DEVICE = method_config["DEVICE"]
+    # experiments fall back to CPU, if CUDA is not available
+    if "cuda" in DEVICE and not torch.cuda.is_available():
+        DEVICE = "cpu"
+    return (method_config["base_model_name"], method_config["cache_dir"], get_model_variant(method_config, DEVICE))
+
+
+def plan_benchmark(dataset_names, methods_config, available_experiments):
+    """
+    Args:
+        dataset_names (list[str]): names of the datasets in the benchmark
+        methods_config (list[dict]): configuration of each method
+        available_experiments (list): locally available Experiment subclasses
+
+    Returns a list of steps, each being a dictionary with the following items:
+        type - "job" for running a method on a dataset, or "shared_scoring" for filling the token statistics archive
+        experiment - Experiment subclass to be run (None for Hugging Face Hub models)
+        method_config - configuration of the method
+        models - list of models required by the step
+        datasets - list of dataset names the step works with
+        method_index, sub_index - position of the job in the methods configuration (used to restore the output order)
+    """
+    available_exp_names = [experiment.__name__ for experiment in available_experiments]
+
+    jobs = []
+    for dataset_name in dataset_names:
+        for method_index, method_config in enumerate(methods_config):
+            if method_config["name"] == "all":
+                experiments = list(enumerate(available_experiments))
+            elif method_config["name"] in available_exp_names:
+                experiments = [(0, available_experiments[available_exp_names.index(method_config["name"])])]
+            else:
+                experiments = [(0, None)]
+            for sub_index, experiment in experiments:
+                jobs.append({
+                    "type": "job",
+                    "experiment": experiment,
+                    "method_config": method_config,
+                    "models": get_required_models(experiment, method_config),
+                    "datasets": [dataset_name],
+                    "method_index": method_index,
+                    "sub_index": sub_index,
+                })
+
+    # Jobs requiring the same models end up next to each other, otherwise the original order is kept
+    jobs.sort(key=lambda job: sorted(job["models"]))
+
+    plan = []
+    shared_scoring_groups = set()
+    for job in jobs:
+        experiment, method_config = job["experiment"], job["method_config"]
+        if uses_shared_scoring(experiment, method_config):
+            group = get_shared_scoring_group(method_config)
+            group_jobs = [other for other in jobs
+                          if uses_shared_scoring(other["experiment"], other["method_config"]) and
+                             get_shared_scoring_group(other["method_config"]) == group]
+            if group not in shared_scoring_groups and len(group_jobs) > 1:
+                shared_scoring_groups.add(group)
+                plan.append({
+                    "type": "shared_scoring",
+                    "experiment": experiment,
+                    "method_config": method_config,
+                    "models": job["models"],
+                    "datasets": list(dict.fromkeys(dataset for other in group_jobs for dataset in other["datasets"])),
+                })
+        plan.append(job)
+
+    return plan
+
+
+def get_step_name(step):
+    if step["experiment"] is None:
+        return step["method_config"]["name"]
+    return step["experiment"].__name__
+
+
+def format_plan(plan):
+    lines = []
+    for idx, step in enumerate(plan):
+        models = ", ".join(f"{model_type} {name}" for model_type, name in step["models"]) or "-"
+        if step["type"] == "shared_scoring":
+            lines.append(f"{idx + 1:>3}. shared scoring pass with {step['method_config']['base_model_name']}"
+                         f" on datasets {', '.join(step['datasets'])} (models: {models})")
+        else:
+            lines.append(f"{idx + 1:>3}. {get_step_name(step)} on {step['datasets'][0]} (models: {models})")
+    return "\n".join(lines)
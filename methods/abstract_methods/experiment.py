@@ -2,6 +2,7 @@ class Experiment:
     def __init__(self, data, name):
         self.data = data
         self.name = name
+        self.checkpoint = None # JobCheckpoint for partial results, set by the benchmark when running resumable jobs
     
     def run(self):
         raise NotImplementedError("Attempted to call an abstract method.")
\ No newline at end of file
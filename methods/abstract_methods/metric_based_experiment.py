@@ -4,28 +4,16 @@ import os
 import torch
 import torch.nn.functional as F
 import time
-from methods.utils import timeit, move_model_to_device, cal_metrics
+from methods.utils import timeit, move_model_to_device, get_clf_results, load_base_model_and_tokenizer, get_token_stats, get_length_sorted_batches, \
+                          apply_cpu_precision, get_cpu_precision, get_model_variant
 from methods.abstract_methods.experiment import Experiment
+from methods.token_stats_archive import TokenStatsArchive
+from methods.tokenization_cache import get_tokenization_cache
+from methods.compiled_inference import compile_model, is_compiled
+from methods.model_pool import load_from_pool
+from methods.parallel import imap_data_parallel
 import gc
 
-from sklearn.linear_model import LogisticRegression
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.svm import SVC
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
-from sklearn.neural_network import MLPClassifier
-
-
-CLF_MODELS = {
-    "LogisticRegression": LogisticRegression,
-    "KNeighborsClassifier": KNeighborsClassifier,
-    "SVC": SVC,
-    "DecisionTreeClassifier": DecisionTreeClassifier,
-    "RandomForestClassifier": RandomForestClassifier,
-    "MLPClassifier": MLPClassifier,
-    "AdaBoostClassifier": AdaBoostClassifier
-}
-
 
 class MetricBasedExperiment(Experiment):
     
@@ -37,11 +25,16 @@ class MetricBasedExperiment(Experiment):
         self.base_model = None
         self.base_tokenizer = None
         self.threshold = config.get("threshold")
+        self.batch_size = config.get("batch_size", 16)
+        self.use_token_stats_archive = config.get("token_stats_archive", False)
+        self.token_stats_archive = None
+        self.tokenization_cache = None
         self.config = config
     
     def criterion_fn(self, text: str):
         """
-        This is an abstract methods only. You should overwrite it in your own child class.
+        This is an abstract methods only. You should overwrite it in your own child class
+        (unless you implement criterion_from_token_stats instead).
         Method takes an input text and computes a numeric score out of it.
 
         Args:
@@ -49,8 +42,121 @@ class MetricBasedExperiment(Experiment):
             
         Returns a numeric score assigned to the input text by the criterion.
         """
+        stats = self.get_token_stats([text])[0]
+        return self.criterion_from_token_stats(stats)
+
+    def criterion_from_token_stats(self, stats: dict):
+        """
+        Overwrite this method instead of criterion_fn, if your criterion can be computed
+        solely from the per-token statistics of the base model (see get_token_stats in methods/utils.py).
+        All such statistics are then obtained from a single forward pass of the base model.
+
+        Args:
+            stats (dict): per-token statistics of a single text
+            
+        Returns a numeric score assigned to the text by the criterion.
+        """
         raise NotImplementedError("Attempted to call an abstract method.")
 
+    def criterion_batch_fn(self, texts: list):
+        """
+        Compute criteria for a whole batch of texts at once. You can overwrite it in your own child class,
+        if your criterion can be computed more efficiently in batches.
+        By default, criterion_from_token_stats is evaluated on the statistics of the whole
+        batch obtained in a single forward pass, or criterion_fn is called for each text separately.
+
+        Args:
+            texts (list[str])
+            
+        Returns a list of numeric scores, one for each input text.
+        """
+        if self.uses_token_stats():
+            return [self.criterion_from_token_stats(stats) for stats in self.get_token_stats(texts)]
+        return [self.criterion_fn(text) for text in texts]
+
+    def uses_token_stats(self):
+        return type(self).criterion_from_token_stats is not MetricBasedExperiment.criterion_from_token_stats
+
+    def get_token_stats(self, texts: list):
+        """Get per-token statistics of the base model for texts, reusing the token statistics archive if enabled"""
+        if self.token_stats_archive is not None:
+            return self.token_stats_archive.get_token_stats(texts, self.base_model, self.base_tokenizer, self.DEVICE)
+        return get_token_stats(texts, self.base_model, self.base_tokenizer, self.DEVICE, tokenization_cache=self.tokenization_cache)
+
+    def compute_criterion(self, texts: list, partition: str):
+        """
+        Evaluate criterion_batch_fn on length-sorted batches of texts and return the criteria in the original order.
+        If the experiment has a checkpoint, criteria computed so far are periodically saved to it
+        and criteria restored from it are not computed again.
+        """
+        criterion = [None] * len(texts)
+        done = {}
+        if self.checkpoint is not None:
+            done = self.checkpoint.get(f"criterion_{partition}", texts)
+            for idx, res in done.items():
+                criterion[idx] = np.array(res)
+        
+        batches = [[idx for idx in batch if idx not in done] for batch in get_length_sorted_batches(texts, self.batch_size)]
+        batches = [batch for batch in batches if batch]
+        # batches are processed by worker processes if the data-parallel execution is enabled
+        results = imap_data_parallel(self.criterion_batch_fn, [[texts[idx] for idx in batch] for batch in batches], self.config, self.DEVICE)
+        for batch, batch_results in tqdm(zip(batches, results), total=len(batches), desc=f"Computing metrics on {partition} partition"):
+            for idx, res in zip(batch, batch_results):
+                criterion[idx] = res
+            if self.checkpoint is not None:
+                self.checkpoint.update(f"criterion_{partition}", {idx: np.asarray(res).tolist() for idx, res in zip(batch, batch_results)})
+        return criterion
+
+    def archive_token_stats(self, texts: list):
+        """Pass the texts not archived yet through the base model in length-sorted batches and store their statistics in the archive"""
+        missing = [text for text in dict.fromkeys(texts) if text not in self.token_stats_archive]
+        self.open_tokenization_cache(missing, self.token_stats_archive.max_length)
+        batches = [[missing[idx] for idx in batch] for batch in get_length_sorted_batches(missing, self.batch_size)]
+        # statistics are only computed by the worker processes, the archive is written to by this process alone
+        stats = imap_data_parallel(
+            lambda batch: get_token_stats(batch, self.base_model, self.base_tokenizer, self.DEVICE, max_length=self.token_stats_archive.max_length,
+                                          tokenization_cache=self.tokenization_cache),
+            batches, self.config, self.DEVICE)
+        for batch, batch_stats in tqdm(zip(batches, stats), total=len(batches), desc="Computing token statistics"):
+            self.token_stats_archive.add(batch, batch_stats)
+
+    def open_tokenization_cache(self, texts: list, max_length=512):
+        """
+        Open the tokenization cache of the base tokenizer (if enabled in config) and tokenize the texts not cached yet,
+        so that the worker processes only read the token ids from it.
+        """
+        if not self.config.get("tokenization_cache", False) or not self.uses_token_stats():
+            return
+        self.tokenization_cache = get_tokenization_cache(self.cache_dir, self.base_tokenizer, max_length)
+        self.tokenization_cache.add(texts)
+
+    def fill_token_stats_archive(self, texts: list):
+        """
+        Compute the per-token statistics of all texts not archived yet and store them in the token statistics archive,
+        so that later runs of any metric-based method using the same base model can read them without the base model.
+        Used to score texts of multiple datasets in one shared pass.
+        """
+        if "cuda" in self.DEVICE and not torch.cuda.is_available():
+            self.DEVICE = "cpu"
+        self.token_stats_archive = TokenStatsArchive(self.cache_dir, self.base_model_name, self.base_model_name,
+                                                     variant=get_model_variant(self.config, self.DEVICE))
+        if self.token_stats_archive.contains_all(texts):
+            return
+        self.base_model, self.base_tokenizer = load_from_pool(
+            self.config, ("base", self.base_model_name, get_model_variant(self.config, self.DEVICE), self.DEVICE), self.load_base_model)
+        self.archive_token_stats(texts)
+        del self.base_model
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def load_base_model(self):
+        print(f"Loading BASE model {self.base_model_name}\n")
+        base_model, base_tokenizer = load_base_model_and_tokenizer(self.base_model_name, self.cache_dir, self.config)
+        move_model_to_device(base_model, self.DEVICE)
+        base_model = apply_cpu_precision(base_model, self.config, self.DEVICE)
+        base_model = compile_model(base_model, self.config, self.DEVICE)
+        return base_model, base_tokenizer
+
     @timeit
     def run(self):
         start_time = time.time()
@@ -63,27 +169,35 @@ class MetricBasedExperiment(Experiment):
             print(f'Setting default device to cpu. Cuda is not available.')
             self.DEVICE = "cpu"
 
-        print(f"Loading BASE model {self.base_model_name}\n")
-        self.base_model, self.base_tokenizer = load_base_model_and_tokenizer(
-            self.base_model_name, self.cache_dir)
-        move_model_to_device(self.base_model, self.DEVICE)
+        # get train data
+        train_text = self.data['train']['text']
+        train_label = self.data['train']['label']
+        test_text = self.data['test']['text']
+        test_label = self.data['test']['label']
+
+        if self.use_token_stats_archive and self.uses_token_stats():
+            self.token_stats_archive = TokenStatsArchive(self.cache_dir, self.base_model_name, self.base_model_name,
+                                                         variant=get_model_variant(self.config, self.DEVICE))
+            print(f"Using token statistics archive {self.token_stats_archive.path}")
+
+        if self.token_stats_archive is not None and self.token_stats_archive.contains_all(train_text + test_text):
+            print(f"All token statistics are archived, skipping loading of BASE model {self.base_model_name}\n")
+        else:
+            self.base_model, self.base_tokenizer = load_from_pool(
+                self.config, ("base", self.base_model_name, get_model_variant(self.config, self.DEVICE), self.DEVICE), self.load_base_model)
+            if self.token_stats_archive is not None:
+                self.archive_token_stats(train_text + test_text)
+            else:
+                self.open_tokenization_cache(train_text + test_text)
             
         torch.manual_seed(0)
         np.random.seed(0)
 
-        # get train data
-        train_text = self.data['train']['text']
-        train_label = self.data['train']['label']
-        t1 = time.time()
-        train_criterion = [self.criterion_fn(train_text[idx])
-                        for idx in tqdm(range(len(train_text)), desc="Computing metrics on train partition")]
+        train_criterion = self.compute_criterion(train_text, "train")
         x_train = np.array(train_criterion)
         y_train = train_label
 
-        test_text = self.data['test']['text']
-        test_label = self.data['test']['label']
-        test_criterion = [self.criterion_fn(test_text[idx])
-                        for idx in tqdm(range(len(test_text)), desc="Computing metrics on test partition")]
+        test_criterion = self.compute_criterion(test_text, "test")
         x_test = np.array(test_criterion)
         y_test = test_label
         train_pred, test_pred, train_pred_prob, test_pred_prob, train_res, test_res = get_clf_results(x_train, y_train, x_test, y_test, config=self.config)
@@ -110,6 +224,8 @@ class MetricBasedExperiment(Experiment):
             'machine_prob': {'train': train_pred_prob, 'test': test_pred_prob},
             'criterion': {'train': [elem.tolist() for elem in train_criterion], 'test': [elem.tolist() for elem in test_criterion]},
             'running_time_seconds': end_time - start_time,
+            'cpu_precision': get_cpu_precision(self.config, self.DEVICE),
+            'compiled': is_compiled(self.config),
             'metrics_results': {
                 'train': {
                     'acc': acc_train,
@@ -117,7 +233,7 @@ class MetricBasedExperiment(Experiment):
                     'recall': recall_train,
                     'f1': f1_train
                 },
-                'test': {mator based on name
+                'test': {
                     'acc': acc_test,
                     'precision': precision_test,
                     'recall': recall_test,
@@ -130,47 +246,3 @@ class MetricBasedExperiment(Experiment):
 
 def threshold_calibration():
     pass
-
-def get_clf_results(x_train, y_train, x_test, y_test, config):
-
-    clf_algo_config = config["clf_algo_for_threshold"]
-    clf_algo_name = clf_algo_config["name"]
-    if clf_algo_name is None:
-        
-    if CLF_MODELS.get(clf_algo_name) is None:
-        raise ValueError(f"Unsupported classification algorithm for threshold computation selected: {clf_algo_name}")
-    
-    clf_algo = CLF_MODELS[clf_algo_name]
-    clf_model = clf_algo(**{key: value for key, value in clf_algo_config.items() if key != 'name'})
-    clf = clf_model.fit(x_train, y_train)
-
-    y_train_pred = clf.predict(x_train)
-    y_train_pred_prob = clf.predict_proba(x_train)
-    y_train_pred_prob = [_[1] for _ in y_train_pred_prob]
-    acc_train, precision_train, recall_train, f1_train, auc_train = cal_metrics(
-        y_train, y_train_pred, y_train_pred_prob)
-    train_res = acc_train, precision_train, recall_train, f1_train, auc_train
-
-    y_test_pred = clf.predict(x_test)
-    y_test_pred_prob = clf.predict_proba(x_test)
-    
-    y_test_pred_prob = [_[1] for _ in y_test_pred_prob]
-    acc_test, precision_test, recall_test, f1_test, auc_test = cal_metrics(
-        y_test, y_test_pred, y_test_pred_prob)
-    test_res = acc_test, precision_test, recall_test, f1_test, auc_test
-
-    return y_train_pred, y_test_pred, y_train_pred_prob, y_test_pred_prob, train_res, test_res
-
-def load_base_model_and_tokenizer(name, cache_dir):
-
-    base_model = transformers.AutoModelForCausalLM.from_pretrained(
-        name, cache_dir=cache_dir)
-    base_tokenizer = transformers.AutoTokenizer.from_pretrained(
-        name, cache_dir=cache_dir)
-    base_tokenizer.pad_token_id = base_tokenizer.eos_token_id
-    if base_tokenizer.pad_token is None:
-        base_tokenizer.add_special_tokens({'pad_token': '[PAD]'})
-        base_model.resize_token_embeddings(len(base_tokenizer))
-
-
-    return base_model, base_tokenizer
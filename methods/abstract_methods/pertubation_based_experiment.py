@@ -8,10 +8,24 @@ import random
 import time
 import os
 from tqdm import tqdm
-from methods.utils import load_base_model_and_tokenizer, move_model_to_device, get_clf_results, timeit
+from methods.utils import load_base_model_and_tokenizer, move_model_to_device, reset_peak_memory, get_peak_memory, get_clf_results, fit_threshold_clf, timeit, get_token_stats, get_length_sorted_batches, \
+                          apply_cpu_precision, get_cpu_precision, get_model_variant
+from methods.compiled_inference import compile_model, is_compiled
+from methods.model_pool import load_from_pool, release_from_pool
+from methods.parallel import imap_data_parallel, iterate_producer_process, can_fork
+from methods.perturbation_store import PerturbationStore
 import gc
+import functools
+import statistics
 
-FILL_DICTIONARY = set()
+# words of the datasets, the random fills are sampled from (for random_fills perturbations)
+FILL_DICTIONARY = np.array([], dtype=object)
+
+# seed of the random number generators used for the perturbations
+PERTURBATION_SEED = 0
+
+# upper estimate of the number of mask filling model tokens per word of a generated fill
+MAX_FILL_TOKENS_PER_WORD = 3
 
 class PertubationBasedExperiment(Experiment):
      def __init__(self, data, name, config): # Add extra parameters if needed
@@ -24,13 +38,85 @@ class PertubationBasedExperiment(Experiment):
         self.base_tokenizer = None
         self.mask_model = None
         self.start_time = None
+        self.batch_size = config.get("batch_size", 16)
+        self.peak_memory = None
+        # words of the data the random fills are sampled from, built on the first run of the experiment
+        self.fill_dictionary = None
+        # time of scoring all texts and of scoring them with each of the counts of perturbations (see compute_perturbation_results)
+        self.scoring_seconds = 0
+        self.prefix_scoring_seconds = None
      
      def get_score(self, text, perturbed_texts, base_model, base_tokenizer, DEVICE):
+        """
+        This is an abstract method only. You should overwrite it in your own child class
+        (unless you implement score_from_token_stats instead).
+        Method takes an original text with its perturbed versions and computes a numeric score out of them.
+        """
+        stats = get_token_stats([text] + perturbed_texts, base_model, base_tokenizer, DEVICE)
+        return self.score_from_token_stats(stats[0], stats[1:])
+
+     def score_from_token_stats(self, stats, perturbed_stats):
+        """
+        Overwrite this method instead of get_score, if your score can be computed solely from the per-token statistics
+        of the base model (see get_token_stats in methods/utils.py). The original texts and all of their perturbations
+        are then scored in batched forward passes and identical texts are scored only once.
+
+        Args:
+            stats (dict): per-token statistics of the original text
+            perturbed_stats (list[dict]): per-token statistics of each of the perturbed texts
+            
+        Returns a numpy array with the score of the original text.
+        """
         raise NotImplementedError("Attempted to call an abstract method.")
+
+     def uses_token_stats(self):
+        return type(self).score_from_token_stats is not PertubationBasedExperiment.score_from_token_stats
+
+     def score_batch(self, results, base_model, base_tokenizer, counts=None):
+        """
+        Score a list of partition results (dictionaries with the text and perturbed_text items).
+        If the score is computed from the per-token statistics, the unique texts among the original
+        and perturbed texts are passed through the base model once, in length-sorted batches.
+        If counts (list of numbers of perturbations) are given, each text is scored with each of the given numbers
+        of its first perturbations and a list of scores (one per count) is returned for each text, together with
+        the timings of the counts (see get_prefix_scoring_seconds).
+        """
+        stats = {}
+        def add_token_stats(n):
+            texts = list(dict.fromkeys(text for res in results for text in [res["text"]] + res["perturbed_text"][:n] if text not in stats))
+            for batch in get_length_sorted_batches(texts, self.batch_size):
+                batch_texts = [texts[idx] for idx in batch]
+                stats.update(zip(batch_texts, get_token_stats(batch_texts, base_model, base_tokenizer, self.DEVICE)))
+
+        if not self.uses_token_stats():
+            score = lambda res, n: self.get_score(res["text"], res["perturbed_text"][:n], base_model, base_tokenizer, self.DEVICE)
+        else:
+            score = lambda res, n: self.score_from_token_stats(stats[res["text"]], [stats[text] for text in res["perturbed_text"][:n]])
+        
+        if counts is None:
+            if self.uses_token_stats():
+                add_token_stats(None)
+            return [score(res, None) for res in results]
+        
+        # token statistics are added with each count only for the perturbations not used by the smaller counts,
+        # so that the time of scoring the texts with each count can be measured
+        scores = [[] for _ in results]
+        timings = np.zeros((2, len(counts)))
+        for count_idx, n in enumerate(counts):
+            start = time.time()
+            if self.uses_token_stats():
+                add_token_stats(n)
+            timings[0, count_idx] = time.time() - start
+            start = time.time()
+            for res, res_scores in zip(results, scores):
+                res_scores.append(score(res, n))
+            timings[1, count_idx] = time.time() - start
+        return scores, timings
      
      @timeit
      def run(self):
         self.start_time = time.time()
+        self.scoring_seconds = 0
         
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
@@ -39,21 +125,79 @@ class PertubationBasedExperiment(Experiment):
             print(f'Setting default device to cpu. Cuda is not available.')
             self.DEVICE = "cpu"
         
-        print(f"Loading BASE model {self.base_model_name}\n")
-        self.base_model, self.base_tokenizer = load_base_model_and_tokenizer(
-            self.base_model_name, self.cache_dir)
-        move_model_to_device(self.base_model, self.DEVICE) 
+        # in the phased mode, the mask filling model and the base model are never loaded at the same time
+        phased = self.config.get("phased", False) and not self.config["random_fills"]
+        if phased:
+            # scoring starts only after all perturbations are generated, so the texts can be neither scored
+            # while they are perturbed nor perturbed until their scores are decided
+            ignored = [option for option in ("adaptive_perturbations", "pipeline") if self.config.get(option, False)]
+            if ignored:
+                print(f"WARNING: {' and '.join(ignored)} cannot be combined with the phased mode and will be ignored.")
+        reset_peak_memory(self.DEVICE)
+        
+        if not phased:
+            self.base_model, self.base_tokenizer = load_from_pool(
+                self.config, ("base", self.base_model_name, get_model_variant(self.config, self.DEVICE), self.DEVICE), self.load_base_model)
         
         mask_filling_model_name = self.config["mask_filling_model_name"]
-        cache_dir = self.config["cache_dir"]
 
         # get mask filling model (for DetectGPT only)
         if self.config["random_fills"]:
-            FILL_DICTIONARY = set()
-            for texts in self.data['train']['text'] + self.data['test']['text']:
-                for text in texts:
-                    FILL_DICTIONARY.update(text.split())
-            FILL_DICTIONARY = sorted(list(FILL_DICTIONARY))
+            global FILL_DICTIONARY
+            if self.fill_dictionary is None:
+                self.fill_dictionary = get_fill_dictionary(self.data['train']['text'] + self.data['test']['text'])
+            FILL_DICTIONARY = self.fill_dictionary
+            # random fills do not need the mask filling model
+            self.mask_model, mask_tokenizer = None, None
+        else:
+            mask_dtype = "int8" if self.config["int8"] else "bfloat16" if self.config["half"] else get_cpu_precision(self.config, self.DEVICE)
+            mask_key = ("mask", mask_filling_model_name, mask_dtype, self.DEVICE)
+            self.mask_model, mask_tokenizer = load_from_pool(self.config, mask_key, self.load_mask_model_and_tokenizer)
+
+        # perturbation_mode = 'd'
+        perturbation_mode = 'z'
+        # only the largest number of perturbations is generated, smaller ones are evaluated on its prefixes
+        counts = get_perturbation_counts(self.config)
+        n_perturbations = counts[-1]
+        sweep_counts = counts if len(counts) > 1 else None
+
+        if phased:
+            perturbation_results = self.get_phased_perturbation_results(self.config, self.data, mask_tokenizer, mask_key, n_perturbations, sweep_counts)
+        else:
+            perturbation_results = self.get_perturbation_results(
+                self.config, self.data, self.mask_model, mask_tokenizer, self.base_model, self.base_tokenizer, self.config["span_length"], n_perturbations, sweep_counts)
+            self.peak_memory = {"generation_and_scoring": get_peak_memory(self.DEVICE)}
+
+        if sweep_counts is None:
+            return self.evaluate_perturbation_results(self.config, perturbation_results, perturbation_mode,
+                                                      span_length=self.config["span_length"], n_perturbations=n_perturbations)
+        
+        # each count is charged the time of everything but the scoring (loading models and generating perturbations
+        # are shared by all counts) and the time of scoring the texts with its own number of perturbations
+        shared_seconds = time.time() - self.start_time - self.scoring_seconds
+        outputs = []
+        for count_idx, count in enumerate(sweep_counts):
+            print(f"Evaluating {self.name} with {count} perturbations")
+            res = self.evaluate_perturbation_results(self.config, get_prefix_results(perturbation_results, count_idx, count), perturbation_mode,
+                                                     span_length=self.config["span_length"], n_perturbations=count,
+                                                     running_time_seconds=shared_seconds + self.prefix_scoring_seconds[count_idx])
+            res["name"] = f"{self.name} (n_perturbations={count})"
+            res["scoring_time_seconds"] = self.prefix_scoring_seconds[count_idx]
+            res["config"] = dict(self.config, n_perturbations=count)
+            outputs.append(res)
+        return outputs
+    
+     def load_base_model(self):
+        print(f"Loading BASE model {self.base_model_name}\n")
+        base_model, base_tokenizer = load_base_model_and_tokenizer(self.base_model_name, self.cache_dir, self.config)
+        move_model_to_device(base_model, self.DEVICE)
+        base_model = apply_cpu_precision(base_model, self.config, self.DEVICE)
+        base_model = compile_model(base_model, self.config, self.DEVICE)
+        return base_model, base_tokenizer
+
+     def load_mask_model_and_tokenizer(self):
+        mask_filling_model_name = self.config["mask_filling_model_name"]
+        cache_dir = self.config["cache_dir"]
 
         int8_kwargs = {}
         half_kwargs = {}
@@ -63,12 +207,12 @@ class PertubationBasedExperiment(Experiment):
         elif self.config["half"]:
             half_kwargs = dict(torch_dtype=torch.bfloat16)
         print(f'Loading mask filling model {mask_filling_model_name}...')
-        self.mask_model = transformers.AutoModelForSeq2SeqLM.from_pretrained(
+        mask_model = transformers.AutoModelForSeq2SeqLM.from_pretrained(
             mask_filling_model_name, **int8_kwargs, **half_kwargs, cache_dir=cache_dir)
 
         if not self.config["random_fills"]:
             try:
-                n_positions = self.mask_model.config.n_positions
+                n_positions = mask_model.config.n_positions
             except AttributeError:
                 n_positions = 512
         else:
@@ -76,79 +220,303 @@ class PertubationBasedExperiment(Experiment):
 
         mask_tokenizer = transformers.AutoTokenizer.from_pretrained(
             mask_filling_model_name, model_max_length=n_positions, cache_dir=cache_dir)
-
-        # perturbation_mode = 'd'
-        perturbation_mode = 'z'
-        n_perturbations = self.config["n_perturbations"]
-
-        perturbation_results = self.get_perturbation_results(
-            self.config, self.data, self.mask_model, mask_tokenizer, self.base_model, self.base_tokenizer, self.config["span_length"], n_perturbations)
-
-        res = self.evaluate_perturbation_results(self.config, perturbation_results, perturbation_mode,
-                                        span_length=self.config["span_length"], n_perturbations=n_perturbations)
-        return res
+        # the int8 and half options take precedence over the CPU precision
+        if not self.config["int8"] and not self.config["half"]:
+            mask_model = apply_cpu_precision(mask_model, self.config, self.DEVICE)
+        return mask_model, mask_tokenizer
     
-     def get_perturbation_results(self, args, data, mask_model, mask_tokenizer, base_model, base_tokenizer, span_length=10, n_perturbations=1):
+     def get_perturbation_results(self, args, data, mask_model, mask_tokenizer, base_model, base_tokenizer, span_length=10, n_perturbations=1, counts=None):
         load_mask_model(args, mask_model, self.DEVICE)
 
-        torch.manual_seed(0)
-        np.random.seed(0)
+        torch.manual_seed(PERTURBATION_SEED)
+        np.random.seed(PERTURBATION_SEED)
 
         train_text = data['train']['text']
         train_label = data['train']['label']
         test_text = data['test']['text']
         test_label = data['test']['label']
 
-        p_train_text = perturb_texts(args, [x for x in train_text for _ in range(
-            n_perturbations)], mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE=self.DEVICE)
-        p_test_text = perturb_texts(args, [x for x in test_text for _ in range(
-            n_perturbations)], mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE=self.DEVICE)
+        store = None
+        if args.get("perturbation_store", False):
+            store = PerturbationStore(self.cache_dir, args, PERTURBATION_SEED, FILL_DICTIONARY)
+            print(f"Using perturbation store {store.path}")
+
+        if args.get("adaptive_perturbations", False):
+            if counts is not None:
+                print("WARNING: Adaptive number of perturbations cannot be combined with a list of perturbation counts, using all perturbations.")
+            elif args["n_perturbation_rounds"] == 1 and self.uses_token_stats():
+                return self.get_adaptive_perturbation_results(args, data, store, mask_model, mask_tokenizer, base_model, base_tokenizer, n_perturbations)
+            print("WARNING: Adaptive number of perturbations is only supported for a single perturbation round and methods implementing score_from_token_stats, using all perturbations.")
+
+        if args.get("pipeline", False):
+            if args["n_perturbation_rounds"] == 1 and can_fork(self.DEVICE):
+                train = [{"text": text, "label": label} for text, label in zip(train_text, train_label)]
+                test = [{"text": text, "label": label} for text, label in zip(test_text, test_label)]
+                # the checkpoint must not be written to by the producer process
+                checkpoint, self.checkpoint = self.checkpoint, None
+                try:
+                    return self.get_pipelined_perturbation_results(args, train, test, store, mask_model, mask_tokenizer, base_model, base_tokenizer, n_perturbations, counts)
+                finally:
+                    self.checkpoint = checkpoint
+            print("WARNING: Pipelining is only supported for a single perturbation round on CPU, running the stages one after another.")
+
+        train, test = self.generate_perturbations(args, data, store, mask_model, mask_tokenizer, base_tokenizer, n_perturbations)
+
+        # base_model = base_model.to(args["DEVICE"])
+
+        return self.compute_perturbation_results(train, test, base_model, base_tokenizer, args, counts)
+
+     def generate_perturbations(self, args, data, store, mask_model, mask_tokenizer, base_tokenizer, n_perturbations):
+        """Return lists of train and test results (dictionaries with the text, label and perturbed_text items)"""
+        train_text = data['train']['text']
+        train_label = data['train']['label']
+        test_text = data['test']['text']
+        test_label = data['test']['label']
 
-        for _ in range(args["n_perturbation_rounds"] - 1):
+        # perturbations of each text in the previous round, the original texts before the first round
+        p_train_text = [[text] * n_perturbations for text in train_text]
+        p_test_text = [[text] * n_perturbations for text in test_text]
+        for round_idx in range(args["n_perturbation_rounds"]):
             try:
-                p_train_text, p_test_text = perturb_texts(args, p_train_text, mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE=self.DEVICE), perturb_texts(
-                    args, p_test_text, mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE=self.DEVICE)
+                p_train_text, p_test_text = self.perturb_round(args, train_text, p_train_text, round_idx, store, mask_model, mask_tokenizer, base_tokenizer, "train"), \
+                                            self.perturb_round(args, test_text, p_test_text, round_idx, store, mask_model, mask_tokenizer, base_tokenizer, "test")
             except AssertionError:
+                if round_idx == 0:
+                    raise
                 break
 
-        assert len(p_train_text) == len(train_text) * \
-            n_perturbations, f"Expected {len(train_text) * n_perturbations} perturbed samples, got {len(p_train_text)}"
-        assert len(p_test_text) == len(test_text) * \
-            n_perturbations, f"Expected {len(test_text) * n_perturbations} perturbed samples, got {len(p_test_text)}"
-
         train = []
         test = []
         for idx in range(len(train_text)):
             train.append({
                 "text": train_text[idx],
                 "label": train_label[idx],
-                "perturbed_text": p_train_text[idx * n_perturbations: (idx + 1) * n_perturbations],
+                "perturbed_text": p_train_text[idx],
             })
         for idx in range(len(test_text)):
             test.append({
                 "text": test_text[idx],
                 "label": test_label[idx],
-                "perturbed_text": p_test_text[idx * n_perturbations: (idx + 1) * n_perturbations],
+                "perturbed_text": p_test_text[idx],
             })
+        return train, test
+
+     def get_phased_perturbation_results(self, args, data, mask_tokenizer, mask_key, n_perturbations, counts=None):
+        """
+        Generate all perturbations with the mask filling model and persist them in the perturbation store,
+        then free the mask filling model and only after that load the base model to score the texts.
+        Peak memory usage of both phases is stored in self.peak_memory.
+        """
+        print("Generation phase: perturbing texts with the mask filling model")
+        load_mask_model(args, self.mask_model, self.DEVICE)
+        torch.manual_seed(PERTURBATION_SEED)
+        np.random.seed(PERTURBATION_SEED)
+        store = PerturbationStore(self.cache_dir, args, PERTURBATION_SEED, FILL_DICTIONARY)
+        print(f"Using perturbation store {store.path}")
+        train, test = self.generate_perturbations(args, data, store, self.mask_model, mask_tokenizer, None, n_perturbations)
+        self.peak_memory = {"generation": get_peak_memory(self.DEVICE)}
+        print(f"Peak memory of the generation phase: {self.peak_memory['generation']}")
 
-        # base_model = base_model.to(args["DEVICE"])
+        self.mask_model = None
+        release_from_pool(args, mask_key)
+        gc.collect()
+        torch.cuda.empty_cache()
+        reset_peak_memory(self.DEVICE)
+
+        print("Scoring phase: scoring texts with the base model")
+        self.base_model, self.base_tokenizer = load_from_pool(
+            args, ("base", self.base_model_name, get_model_variant(self.config, self.DEVICE), self.DEVICE), self.load_base_model)
+        results = self.compute_perturbation_results(train, test, self.base_model, self.base_tokenizer, args, counts)
+        self.peak_memory["scoring"] = get_peak_memory(self.DEVICE)
+        print(f"Peak memory of the scoring phase: {self.peak_memory['scoring']}")
+        return results
 
-        return self.compute_perturbation_results(train, test, base_model, base_tokenizer, args)
-    
-     def compute_perturbation_results(self, train, test, base_model, base_tokenizer, args):
+     def perturb_round(self, args, texts, previous, round_idx, store, mask_model, mask_tokenizer, base_tokenizer, partition, on_complete=None, known=None):
+        """
+        Perturb the perturbations of texts from the previous round (list of n_perturbations texts for each text).
+        Perturbations found in the perturbation store (or given in known, a list of already generated perturbations of each text)
+        are reused, the missing ones are generated and added to the store.
+        If on_complete is given, it is called with a list of (index of a text, its perturbations) pairs
+        as soon as all perturbations of these texts are done.
+
+        Returns a list of n_perturbations perturbed texts for each text
+        """
+        n_perturbations = len(previous[0]) if previous else 0
+        perturbed = [store.get(text, round_idx)[:n_perturbations] if store is not None else [] for text in texts]
+        if known is not None:
+            perturbed = [max(list(text_known)[:n_perturbations], stored, key=len) for text_known, stored in zip(known, perturbed)]
+        missing = [(idx, p_idx) for idx in range(len(texts)) for p_idx in range(len(perturbed[idx]), n_perturbations)]
+        if store is not None and len(missing) < len(texts) * n_perturbations:
+            print(f"Reusing {len(texts) * n_perturbations - len(missing)} stored perturbations of {partition} texts in round {round_idx}")
+        missing_by_text = {}
+        for k, (idx, _) in enumerate(missing):
+            missing_by_text.setdefault(idx, []).append(k)
+        
+        generated = {}
+        def complete_chunk(chunk, chunk_outputs):
+            """Collect perturbations of the texts, whose perturbations are all done after the chunk, and add them to the store"""
+            generated.update(zip(chunk, chunk_outputs))
+            completed = [idx for idx in dict.fromkeys(missing[k][0] for k in chunk)
+                         if all(k in generated for k in missing_by_text[idx])]
+            for idx in completed:
+                perturbed[idx] = perturbed[idx] + [generated[k] for k in missing_by_text[idx]]
+            if store is not None:
+                store.add([texts[idx] for idx in completed], round_idx, [perturbed[idx] for idx in completed])
+            if on_complete is not None:
+                on_complete([(idx, perturbed[idx]) for idx in completed])
         
-        for res in tqdm(train, desc="Computing metrics"):
-            res["score"] = self.get_score(res["text"], res["perturbed_text"], base_model,
-                            base_tokenizer, self.DEVICE)
+        if on_complete is not None:
+            on_complete([(idx, perturbed[idx]) for idx in range(len(texts)) if idx not in missing_by_text])
+        perturb_texts(args, [previous[idx][p_idx] for idx, p_idx in missing], mask_model, mask_tokenizer, base_tokenizer,
+                      ceil_pct=False, DEVICE=self.DEVICE, checkpoint=self.checkpoint,
+                      checkpoint_name=f"perturbed_{partition}_{round_idx}", callback=complete_chunk)
+        return perturbed
+
+     def get_pipelined_perturbation_results(self, args, train, test, store, mask_model, mask_tokenizer, base_model, base_tokenizer, n_perturbations, counts=None):
+        """
+        Generate perturbations (of a single round) in a forked producer process and score the texts in this process
+        at the same time. Texts are passed to the scoring through a bounded queue as soon as all of their perturbations are done,
+        and scored in chunks of batch_size texts. Each of the stages uses its own number of torch threads.
+        """
+        generation_threads, scoring_threads = get_pipeline_threads(args)
+        print(f"Pipelining perturbation generation ({generation_threads} threads) and scoring ({scoring_threads} threads)")
+
+        def produce(put):
+            for partition, partition_results in [("train", train), ("test", test)]:
+                texts = [res["text"] for res in partition_results]
+                self.perturb_round(args, texts, [[text] * n_perturbations for text in texts], 0, store,
+                                   mask_model, mask_tokenizer, base_tokenizer, partition,
+                                   on_complete=lambda completed, partition=partition: put((partition, completed)) if completed else None)
+
+        results = {"train": train, "test": test}
+        pending = {"train": [], "test": []}
+        progress = tqdm(total=len(train) + len(test), desc="Computing metrics")
+        timings = np.zeros((2, len(counts))) if counts is not None else None
+        def score_pending(partition):
+            nonlocal timings
+            chunk = [results[partition][idx] for idx in pending[partition]]
+            start = time.time()
+            scores = self.score_batch(chunk, base_model, base_tokenizer, counts)
+            self.scoring_seconds += time.time() - start
+            if counts is not None:
+                scores, chunk_timings = scores
+                timings += chunk_timings
+            for res, score in zip(chunk, scores):
+                set_score(res, score, counts)
+            progress.update(len(chunk))
+            pending[partition] = []
+
+        previous_threads = torch.get_num_threads()
+        torch.set_num_threads(scoring_threads)
+        try:
+            for partition, completed in iterate_producer_process(produce, args.get("pipeline_queue_size", 8), generation_threads):
+                for idx, perturbed_texts in completed:
+                    results[partition][idx]["perturbed_text"] = perturbed_texts
+                    pending[partition].append(idx)
+                if len(pending[partition]) >= self.batch_size:
+                    score_pending(partition)
+            for partition in pending:
+                score_pending(partition)
+        finally:
+            torch.set_num_threads(previous_threads)
+            progress.close()
+        if counts is not None:
+            self.prefix_scoring_seconds = get_prefix_scoring_seconds(timings)
+        return results
+    
+     def get_adaptive_perturbation_results(self, args, data, store, mask_model, mask_tokenizer, base_model, base_tokenizer, n_perturbations):
+        """
+        Perturb the train texts n_perturbations times and calibrate the threshold on their scores. Test texts are then perturbed
+        and scored in increments of adaptive_increment perturbations, until the confidence interval of the score of a text
+        (see get_score_interval) lies on one side of the threshold, or the text has n_perturbations perturbations.
+        """
+        train, _ = self.generate_perturbations(args, {"train": data["train"], "test": {"text": [], "label": []}},
+                                               store, mask_model, mask_tokenizer, base_tokenizer, n_perturbations)
+        self.compute_perturbation_results(train, [], base_model, base_tokenizer, args)
+        clf = fit_threshold_clf([res["score"] for res in train], [res["label"] for res in train], args)
+
+        test = [{"text": text, "label": label, "perturbed_text": []} for text, label in zip(data["test"]["text"], data["test"]["label"])]
+        increment = max(2, args.get("adaptive_increment", 3))
+        confidence = args.get("adaptive_confidence", 0.95)
+        stats = {}
+        active = list(range(len(test)))
+        count = 0
+        while active and count < n_perturbations:
+            count = min(n_perturbations, count + increment)
+            texts = [test[idx]["text"] for idx in active]
+            perturbed = self.perturb_round(args, texts, [[text] * count for text in texts], 0, store, mask_model, mask_tokenizer, base_tokenizer,
+                                           f"test_{count}", known=[test[idx]["perturbed_text"] for idx in active])
+            for idx, perturbed_texts in zip(active, perturbed):
+                test[idx]["perturbed_text"] = perturbed_texts
+
+            # only texts that were not scored in the previous increments are passed through the base model
+            missing = list(dict.fromkeys(text for idx in active for text in [test[idx]["text"]] + test[idx]["perturbed_text"] if text not in stats))
+            for batch in get_length_sorted_batches(missing, self.batch_size):
+                batch_texts = [missing[idx] for idx in batch]
+                stats.update(zip(batch_texts, get_token_stats(batch_texts, base_model, base_tokenizer, self.DEVICE)))
+
+            undecided = []
+            for idx in active:
+                text_stats, perturbed_stats = stats[test[idx]["text"]], [stats[text] for text in test[idx]["perturbed_text"]]
+                test[idx]["score"] = self.score_from_token_stats(text_stats, perturbed_stats)
+                lower, upper = self.get_score_interval(text_stats, perturbed_stats, test[idx]["score"], confidence)
+                if clf.predict([lower])[0] != clf.predict([upper])[0]:
+                    undecided.append(idx)
+            print(f"{len(active) - len(undecided)} of {len(active)} test texts decided with {count} perturbations")
+            active = undecided
+        return {"train": train, "test": test}
+
+     def get_score_interval(self, stats, perturbed_stats, score, confidence):
+        """
+        Return the lower and upper bound of the normal confidence interval of the score, with the standard error
+        estimated by the jackknife (leaving out each of the perturbations in turn).
+        """
+        n = len(perturbed_stats)
+        if n < 2:
+            return score, score
+        jackknife_scores = np.array([self.score_from_token_stats(stats, perturbed_stats[:idx] + perturbed_stats[idx + 1:]) for idx in range(n)])
+        standard_error = np.sqrt((n - 1) / n * np.square(jackknife_scores - jackknife_scores.mean(axis=0)).sum(axis=0))
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+        return score - z * standard_error, score + z * standard_error
+
+     def compute_perturbation_results(self, train, test, base_model, base_tokenizer, args, counts=None):
+        """
+        Score the train and test results (see score_batch). If counts are given, the scores with each of the counts
+        of the first perturbations are stored in the prefix_scores item and the score with all of them in the score item,
+        and the time of scoring the texts with each of the counts in self.prefix_scoring_seconds.
+        """
+        start = time.time()
+        timings = np.zeros((2, len(counts))) if counts is not None else None
+        for partition, partition_results in [("train", train), ("test", test)]:
+            done = {}
+            if self.checkpoint is not None:
+                done = self.checkpoint.get(f"score_{partition}", [text for res in partition_results 
+                                                                  for text in [res["text"]] + res["perturbed_text"]])
+            for idx, score in done.items():
+                set_score(partition_results[idx], np.array(score) if counts is None else [np.array(elem) for elem in score], counts)
             
-        for res in tqdm(test, desc="Computing metrics"):
-            res["score"] = self.get_score(res["text"], res["perturbed_text"], base_model,
-                            base_tokenizer, self.DEVICE)
+            pending = [idx for idx in range(len(partition_results)) if idx not in done]
+            chunks = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+            # chunks are scored by worker processes if the data-parallel execution is enabled
+            scores = imap_data_parallel(
+                lambda chunk: self.score_batch(chunk, base_model, base_tokenizer, counts),
+                [[partition_results[idx] for idx in chunk] for chunk in chunks], self.config, self.DEVICE)
+            for chunk, chunk_scores in tqdm(zip(chunks, scores), total=len(chunks), desc="Computing metrics"):
+                if counts is not None:
+                    chunk_scores, chunk_timings = chunk_scores
+                    timings += chunk_timings
+                for idx, score in zip(chunk, chunk_scores):
+                    set_score(partition_results[idx], score, counts)
+                if self.checkpoint is not None:
+                    self.checkpoint.update(f"score_{partition}", {idx: np.asarray(score).tolist() for idx, score in zip(chunk, chunk_scores)})
             
+        self.scoring_seconds += time.time() - start
+        if counts is not None:
+            self.prefix_scoring_seconds = get_prefix_scoring_seconds(timings, time.time() - start)
         results = {"train": train, "test": test}
         return results
 
-     def evaluate_perturbation_results(self, args, results, criterion, span_length=10, n_perturbations=1):
+     def evaluate_perturbation_results(self, args, results, criterion, span_length=10, n_perturbations=1, running_time_seconds=None):
             # Train
             train_predictions = []
             for res in results['train']:
@@ -174,9 +542,9 @@ class PertubationBasedExperiment(Experiment):
             print(f"{self.name} acc_train: {acc_train}, precision_train: {precision_train}, recall_train: {recall_train}, f1_train: {f1_train}, auc_train: {auc_train}")
             print(f"{self.name} acc_test: {acc_test}, precision_test: {precision_test}, recall_test: {recall_test}, f1_test: {f1_test}, auc_test: {auc_test}")
             
-            # Clean up
-            del self.base_model
-            del self.mask_model
+            # Clean up (evaluation may be run repeatedly, once for each number of perturbations)
+            self.base_model = None
+            self.mask_model = None
             gc.collect()
             torch.cuda.empty_cache()
             
@@ -187,7 +555,9 @@ class PertubationBasedExperiment(Experiment):
                 'predictions': {'train': train_pred.tolist(), 'test': test_pred.tolist()},
                 'machine_prob': {'train': train_pred_prob, 'test': test_pred_prob},
                 'criterion': {'train': [elem.tolist() for elem in train_predictions], 'test': [elem.tolist() for elem in test_predictions]},
-                'running_time_seconds': time.time() - self.start_time,
+                'running_time_seconds': running_time_seconds if running_time_seconds is not None else time.time() - self.start_time,
+                'cpu_precision': get_cpu_precision(self.config, self.DEVICE),
+                'compiled': is_compiled(self.config),
                 'metrics_results': {
                     'train': {
                         'acc': acc_train,
@@ -206,7 +576,10 @@ class PertubationBasedExperiment(Experiment):
                     'pct_words_masked': args["pct_words_masked"],
                     'span_length': span_length,
                     'n_perturbations': n_perturbations,
+                    'n_perturbations_used': {'train': [len(res['perturbed_text']) for res in results['train']],
+                                             'test': [len(res['perturbed_text']) for res in results['test']]},
                 },
+                'peak_memory': self.peak_memory,
                 "config": self.config
             }
         
@@ -226,49 +599,72 @@ def load_mask_model(args, mask_model, DEVICE):
     print(f'DONE ({time.time() - start:.2f}s)')
 
 
-def tokenize_and_mask(text, span_length, buffer_size, pct, ceil_pct=False):
-    tokens = text.split(' ')
-    if len(tokens) > 512:
-        tokens = tokens[:512]
-    mask_string = '<<<mask>>>'
-
-    n_spans = pct * len(tokens) / (span_length + buffer_size * 2)
+def sample_mask_spans(n_tokens, span_length, buffer_size, n_spans):
+    """
+    Sample start positions of masked spans of span_length tokens for a batch of texts (n_spans[i] spans in a text
+    of n_tokens[i] tokens), so that at least buffer_size unmasked tokens separate any two spans. If the spans do not fit
+    into a text, as many as fit are sampled. All valid placements of the spans in a text are equally likely.
+
+    Each span blocks the span_length + buffer_size - 1 positions after its start for the next span. Without them,
+    the starts are just distinct positions in a shorter range, which are sampled for all texts at once
+    by sorting a matrix of random keys.
+
+    Returns a list of sorted arrays of the start positions, one for each text
+    """
+    n_tokens, n_spans = np.asarray(n_tokens, dtype=int), np.asarray(n_spans, dtype=int)
+    step = span_length + buffer_size - 1
+    # a span can start at positions 0 ... n_tokens - span_length - 1
+    n_positions = n_tokens - span_length
+    n_spans = np.minimum(n_spans, np.maximum((n_positions + step) // (step + 1), 0))
+    n_compressed = n_positions - np.maximum(n_spans - 1, 0) * step
+    keys = np.random.random((len(n_tokens), max(int(n_compressed.max(initial=0)), 1)))
+    keys[np.arange(keys.shape[1]) >= n_compressed[:, None]] = np.inf
+    order = np.argsort(keys, axis=1)
+    return [np.sort(order[idx, :n_spans[idx]]) + np.arange(n_spans[idx]) * step for idx in range(len(n_tokens))]
+
+
+def tokenize_and_mask_batch(texts, span_length, buffer_size, pct, ceil_pct=False):
+    """
+    Mask spans of span_length (space-separated) tokens of each text (truncated to 512 tokens), so that pct of the tokens
+    together with the buffers around the spans are covered, and replace each span with <extra_id_NUM>, where NUM increments
+    """
+    tokens = [text.split(' ')[:512] for text in texts]
+
+    n_spans = pct * np.array([len(text_tokens) for text_tokens in tokens]) / (span_length + buffer_size * 2)
     if ceil_pct:
         n_spans = np.ceil(n_spans)
-    n_spans = int(n_spans)
-
-    n_masks = 0
-    while n_masks < n_spans:
-        start = np.random.randint(0, len(tokens) - span_length)
-        end = start + span_length
-        search_start = max(0, start - buffer_size)
-        search_end = min(len(tokens), end + buffer_size)
-        if mask_string not in tokens[search_start:search_end]:
-            tokens[start:end] = [mask_string]
-            n_masks += 1
-
-    # replace each occurrence of mask_string with <extra_id_NUM>, where NUM increments
-    num_filled = 0
-    for idx, token in enumerate(tokens):
-        if token == mask_string:
-            tokens[idx] = f'<extra_id_{num_filled}>'
-            num_filled += 1
-    assert num_filled == n_masks, f"num_filled {num_filled} != n_masks {n_masks}"
-    text = ' '.join(tokens)
-    return text
+    n_spans = n_spans.astype(int)
+
+    masked_texts = []
+    for text_tokens, starts in zip(tokens, sample_mask_spans([len(text_tokens) for text_tokens in tokens], span_length, buffer_size, n_spans)):
+        masked_tokens = []
+        end = 0
+        for num_filled, start in enumerate(starts):
+            masked_tokens.extend(text_tokens[end:start])
+            masked_tokens.append(f'<extra_id_{num_filled}>')
+            end = start + span_length
+        masked_tokens.extend(text_tokens[end:])
+        masked_texts.append(' '.join(masked_tokens))
+    return masked_texts
+
+
+# mask tokens, which are separate space-delimited tokens in the masked texts
+mask_token_pattern = re.compile(r"(?<![^ ])<extra_id_\d+>(?![^ ])")
 
 
 def count_masks(texts):
-    return [len([x for x in text.split() if x.startswith("<extra_id_")]) for text in texts]
+    return [len(mask_token_pattern.findall(text)) for text in texts]
 
 
 # replace each masked span with a sample from T5 mask_model
-def replace_masks(texts, mask_model, mask_tokenizer, mask_top_p, DEVICE):
+def replace_masks(texts, mask_model, mask_tokenizer, mask_top_p, DEVICE, span_length=2):
     n_expected = count_masks(texts)
     stop_id = mask_tokenizer.encode(f"<extra_id_{max(n_expected)}>")[0]
     tokens = mask_tokenizer(texts, return_tensors="pt",
                             padding=True).to(DEVICE)
-    outputs = mask_model.generate(**tokens, max_length=150, do_sample=True,
+    # fill of each span takes its sentinel token and about span_length words, the sentinel after the last fill stops the generation
+    max_new_tokens = max(n_expected) * (1 + span_length * MAX_FILL_TOKENS_PER_WORD) + 1
+    outputs = mask_model.generate(**tokens, max_new_tokens=max_new_tokens, do_sample=True,
                                   top_p=mask_top_p, num_return_sequences=1, eos_token_id=stop_id)
     return mask_tokenizer.batch_decode(outputs, skip_special_tokens=False)
 
@@ -287,98 +683,207 @@ def extract_fills(texts):
 
 
 def apply_extracted_fills(masked_texts, extracted_fills):
-    # split masked text into tokens, only splitting on spaces (not newlines)
-    tokens = [x.split(' ') for x in masked_texts]
+    texts = []
+    for text, fills in zip(masked_texts, extracted_fills):
+        # split masked text into parts between the mask tokens, and replace each mask token with the corresponding fill
+        parts = mask_token_pattern.split(text)
+        n_expected = len(parts) - 1
+        if len(fills) < n_expected:
+            texts.append('')
+            continue
+        filled = [parts[0]]
+        for fill, part in zip(fills, parts[1:]):
+            filled.append(fill)
+            filled.append(part)
+        texts.append(''.join(filled))
+    return texts
 
-    n_expected = count_masks(masked_texts)
 
-    # replace each mask token with the corresponding fill
-    for idx, (text, fills, n) in enumerate(zip(tokens, extracted_fills, n_expected)):
-        if len(fills) < n:
-            tokens[idx] = []
-        else:
-            for fill_idx in range(n):
-                text[text.index(f"<extra_id_{fill_idx}>")] = fills[fill_idx]
+def get_perturbation_counts(config):
+    """Return the sorted list of the numbers of perturbations to be evaluated (n_perturbation_list, or just n_perturbations)"""
+    counts = config.get("n_perturbation_list") or [config["n_perturbations"]]
+    return sorted(set(int(count) for count in counts))
 
-    # join tokens back into text
-    texts = [" ".join(x) for x in tokens]
-    return texts
 
+def set_score(res, score, counts=None):
+    """Store the score of a result, or its scores with each of the counts of perturbations (see score_batch)"""
+    if counts is None:
+        res["score"] = score
+    else:
+        res["prefix_scores"] = score
+        res["score"] = score[-1]
+
+
+def get_prefix_scoring_seconds(timings, wall_seconds=None):
+    """
+    Return the time of scoring the texts with each of the counts of perturbations, from the timings summed
+    over the scored batches (see score_batch): the time of computing the token statistics of the texts
+    and of the perturbations added with each count, and the time of computing the scores with each count.
+    Scoring with a count takes the token statistics of all the smaller counts and its own scores.
+    If the batches were scored by several worker processes, the timings are scaled to wall_seconds.
+    """
+    stats_seconds, score_seconds = timings
+    prefix_seconds = np.cumsum(stats_seconds) + score_seconds
+    if wall_seconds is not None and timings.sum() > 0:
+        prefix_seconds = prefix_seconds * min(1, wall_seconds / timings.sum())
+    return prefix_seconds.tolist()
+
+
+def get_prefix_results(results, count_idx, count):
+    """Return a copy of results with only the first count perturbations of each text and their score"""
+    return {partition: [dict(res, perturbed_text=res["perturbed_text"][:count], score=res["prefix_scores"][count_idx])
+                        for res in partition_results]
+            for partition, partition_results in results.items()}
+
+
+def get_pipeline_threads(args):
+    """Return numbers of torch threads of the perturbation generation and scoring stages, by default the CPU cores are split evenly between them"""
+    n_cores = os.cpu_count() or 1
+    generation_threads = args.get("generation_threads") or max(1, n_cores // 2)
+    scoring_threads = args.get("scoring_threads") or max(1, n_cores - generation_threads)
+    return generation_threads, scoring_threads
+
+
+@functools.lru_cache(maxsize=8)
+def get_allowed_token_ids(tokenizer):
+    """Return a tensor of all non-special token ids of the tokenizer (for random_fills_tokens perturbations)"""
+    special_ids = set(tokenizer.all_special_ids)
+    return torch.tensor([token_id for token_id in range(tokenizer.vocab_size) if token_id not in special_ids], dtype=torch.long)
+
+
+def get_fill_dictionary(texts):
+    """Return a sorted array of all words in the texts (for random_fills perturbations)"""
+    words = set()
+    for text in texts:
+        words.update(text.split())
+    return np.array(sorted(words), dtype=object)
+
+
+def sample_fill_words(n_spans, span_length):
+    """
+    Sample span_length distinct words of FILL_DICTIONARY for each of n_spans spans, as random.sample would for each span.
+    Words of all spans are drawn at once and only the spans with a repeated word are drawn again, which keeps the words
+    of each span a uniform sample without replacement. For dictionaries too small for the repeats to be rare,
+    each span is sampled on its own.
+
+    Returns an array of words of shape (n_spans, span_length)
+    """
+    n_words = len(FILL_DICTIONARY)
+    if span_length > n_words:
+        raise ValueError(f"Cannot sample {span_length} distinct fill words from a dictionary of {n_words} words")
+    if n_words < span_length ** 2:
+        return FILL_DICTIONARY[np.array([np.random.choice(n_words, span_length, replace=False) for _ in range(n_spans)], dtype=int).reshape(n_spans, span_length)]
+    indices = np.random.randint(0, n_words, size=(n_spans, span_length))
+    while True:
+        sorted_indices = np.sort(indices, axis=1)
+        repeated = (sorted_indices[:, 1:] == sorted_indices[:, :-1]).any(axis=1)
+        if not repeated.any():
+            return FILL_DICTIONARY[indices]
+        indices[repeated] = np.random.randint(0, n_words, size=(repeated.sum(), span_length))
+
+
+def fill_masks(args, texts, mask_model, mask_tokenizer, ceil_pct=False, DEVICE="cpu"):
+    """Mask the texts and fill the masks with the mask filling model once, texts with a wrong number of fills are returned as ''"""
+    span_length = args["span_length"]
+    masked_texts = tokenize_and_mask_batch(texts, span_length, args["buffer_size"], args["pct_words_masked"], ceil_pct)
+    raw_fills = replace_masks(
+        masked_texts, mask_model, mask_tokenizer, args["mask_top_p"], DEVICE, span_length)
+    extracted_fills = extract_fills(raw_fills)
+    return apply_extracted_fills(masked_texts, extracted_fills)
 
-def perturb_texts_(args, texts, mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE="cpu"):
+
+def random_fill_texts(args, texts, base_tokenizer, ceil_pct=False, DEVICE="cpu"):
+    """Perturb texts without the mask filling model, by replacing random tokens (random_fills_tokens) or masked spans with random words"""
     span_length = args["span_length"]
     buffer_size = args["buffer_size"]
-    mask_top_p = args["mask_top_p"]
     pct = args["pct_words_masked"]
-    if not args["random_fills"]:
-        masked_texts = [tokenize_and_mask(
-            x, span_length, buffer_size, pct, ceil_pct) for x in texts]
-        raw_fills = replace_masks(
-            masked_texts, mask_model, mask_tokenizer, mask_top_p, DEVICE)
-        extracted_fills = extract_fills(raw_fills)
-        perturbed_texts = apply_extracted_fills(masked_texts, extracted_fills)
-
-        # Handle the fact that sometimes the model doesn't generate the right number of fills and we have to try again
-        attempts = 1
-        while '' in perturbed_texts:
-            idxs = [idx for idx, x in enumerate(perturbed_texts) if x == '']
-            print(
-                f'WARNING: {len(idxs)} texts have no fills. Trying again [attempt {attempts}].')
-            masked_texts = [tokenize_and_mask(
-                x, span_length, pct, ceil_pct) for idx, x in enumerate(texts) if idx in idxs]
-            raw_fills = replace_masks(
-                masked_texts, mask_model, mask_tokenizer, mask_top_p, DEVICE)
-            extracted_fills = extract_fills(raw_fills)
-            new_perturbed_texts = apply_extracted_fills(
-                masked_texts, extracted_fills)
-            for idx, x in zip(idxs, new_perturbed_texts):
-                perturbed_texts[idx] = x
-            attempts += 1
+    if args["random_fills_tokens"]:
+        # tokenize base_tokenizer
+        tokens = base_tokenizer(
+            texts, return_tensors="pt", padding=True).to(DEVICE)
+        valid_tokens = tokens.input_ids != base_tokenizer.pad_token_id
+        replace_pct = pct * \
+            (span_length / (span_length + 2 * buffer_size))
+
+        # replace replace_pct of input_ids with random non-special tokens
+        random_mask = torch.rand(
+            tokens.input_ids.shape, device=DEVICE) < replace_pct
+        random_mask &= valid_tokens
+        allowed_token_ids = get_allowed_token_ids(base_tokenizer).to(DEVICE)
+        random_tokens = allowed_token_ids[torch.randint(
+            0, len(allowed_token_ids), (random_mask.sum(),), device=DEVICE)]
+        tokens.input_ids[random_mask] = random_tokens
+        perturbed_texts = base_tokenizer.batch_decode(
+            tokens.input_ids, skip_special_tokens=True)
     else:
-        if args["random_fills_tokens"]:
-            # tokenize base_tokenizer
-            tokens = base_tokenizer(
-                texts, return_tensors="pt", padding=True).to(DEVICE)
-            valid_tokens = tokens.input_ids != base_tokenizer.pad_token_id
-            replace_pct = pct * \
-                (span_length / (span_length + 2 * buffer_size))
-
-            # replace replace_pct of input_ids with random tokens
-            random_mask = torch.rand(
-                tokens.input_ids.shape, device=DEVICE) < replace_pct
-            random_mask &= valid_tokens
-            random_tokens = torch.randint(
-                0, base_tokenizer.vocab_size, (random_mask.sum(),), device=DEVICE)
-            # while any of the random tokens are special tokens, replace them with random non-special tokens
-            while any(base_tokenizer.decode(x) in base_tokenizer.all_special_tokens for x in random_tokens):
-                random_tokens = torch.randint(
-                    0, base_tokenizer.vocab_size, (random_mask.sum(),), device=DEVICE)
-            tokens.input_ids[random_mask] = random_tokens
-            perturbed_texts = base_tokenizer.batch_decode(
-                tokens.input_ids, skip_special_tokens=True)
-        else:
-            print("This here:", FILL_DICTIONARY)
-            masked_texts = [tokenize_and_mask(
-                x, span_length, pct, ceil_pct) for x in texts]
-            perturbed_texts = masked_texts
-            # replace each <extra_id_*> with args["span_length"] random words from FILL_DICTIONARY
-            for idx, text in enumerate(perturbed_texts):
-                filled_text = text
-                for fill_idx in range(count_masks([text])[0]):
-                    fill = random.sample(FILL_DICTIONARY, span_length)
-                    filled_text = filled_text.replace(
-                        f"<extra_id_{fill_idx}>", " ".join(fill))
-                assert count_masks([filled_text])[
-                    0] == 0, "Failed to replace all masks"
-                perturbed_texts[idx] = filled_text
+        masked_texts = tokenize_and_mask_batch(texts, span_length, buffer_size, pct, ceil_pct)
+        # replace each <extra_id_*> with args["span_length"] random words from FILL_DICTIONARY
+        n_masks = count_masks(masked_texts)
+        fills = [" ".join(span_words) for span_words in sample_fill_words(sum(n_masks), span_length)]
+        offsets = np.cumsum([0] + n_masks)
+        perturbed_texts = apply_extracted_fills(
+            masked_texts, [fills[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+        assert sum(count_masks(perturbed_texts)) == 0, "Failed to replace all masks"
 
     return perturbed_texts
 
 
-def perturb_texts(args, texts, mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE="cpu"):
-
-    outputs = []
-    for i in tqdm(range(0, len(texts), args["chunk_size"]), desc="Applying perturbations"):
-        outputs.extend(perturb_texts_(args,
-                                      texts[i:i + args["chunk_size"]], mask_model, mask_tokenizer, base_tokenizer, ceil_pct=ceil_pct, DEVICE=DEVICE))
+def perturb_texts(args, texts, mask_model, mask_tokenizer, base_tokenizer, ceil_pct=False, DEVICE="cpu", checkpoint=None, checkpoint_name=None, callback=None):
+    """
+    Perturb texts in chunks of chunk_size texts of similar length (so that little padding is needed in the mask filling)
+    and return the perturbed texts in the original order. If callback is given, it is called with the indices
+    and perturbed texts of each chunk as soon as all texts of the chunk are done.
+
+    Texts the mask filling model fails to fill (with a wrong number of fills) are collected across the chunks
+    and masked and filled again in batches of chunk_size texts, each of them once per round, until all are filled.
+    """
+    chunk_size = args["chunk_size"]
+    chunks = get_length_sorted_batches(texts, chunk_size)
+    done = checkpoint.get(checkpoint_name, texts) if checkpoint is not None else {}
+    outputs = [None] * len(texts)
+    chunk_of = {idx: chunk_idx for chunk_idx, chunk in enumerate(chunks) for idx in chunk}
+    n_unfilled = {}  # chunk index -> number of its texts waiting to be filled again
+    retry_queue = []  # indices of the texts to be filled again
+
+    def complete_chunk(chunk_idx):
+        chunk_outputs = [outputs[idx] for idx in chunks[chunk_idx]]
+        if checkpoint is not None and chunk_idx not in done:
+            checkpoint.update(checkpoint_name, {chunk_idx: chunk_outputs})
+        if callback is not None:
+            callback(chunks[chunk_idx], chunk_outputs)
+
+    def retry(batch):
+        print(f'WARNING: {len(batch)} texts have no fills. Trying again.')
+        for idx, output in zip(batch, fill_masks(args, [texts[idx] for idx in batch], mask_model, mask_tokenizer, ceil_pct, DEVICE)):
+            if output == '':
+                retry_queue.append(idx)
+                continue
+            outputs[idx] = output
+            n_unfilled[chunk_of[idx]] -= 1
+            if n_unfilled[chunk_of[idx]] == 0:
+                del n_unfilled[chunk_of[idx]]
+                complete_chunk(chunk_of[idx])
+
+    for chunk_idx, chunk in enumerate(tqdm(chunks, desc="Applying perturbations")):
+        if chunk_idx in done:
+            chunk_outputs = done[chunk_idx]
+        elif args["random_fills"]:
+            chunk_outputs = random_fill_texts(args, [texts[idx] for idx in chunk], base_tokenizer, ceil_pct=ceil_pct, DEVICE=DEVICE)
+        else:
+            chunk_outputs = fill_masks(args, [texts[idx] for idx in chunk], mask_model, mask_tokenizer, ceil_pct, DEVICE)
+        for idx, output in zip(chunk, chunk_outputs):
+            outputs[idx] = output
+        failed = [idx for idx, output in zip(chunk, chunk_outputs) if output == '']
+        if not failed:
+            complete_chunk(chunk_idx)
+            continue
+        n_unfilled[chunk_idx] = len(failed)
+        retry_queue.extend(failed)
+        while len(retry_queue) >= chunk_size:
+            batch, retry_queue[:] = retry_queue[:chunk_size], retry_queue[chunk_size:]
+            retry(batch)
+
+    while retry_queue:
+        batch, retry_queue[:] = retry_queue[:chunk_size], retry_queue[chunk_size:]
+        retry(batch)
     return outputs
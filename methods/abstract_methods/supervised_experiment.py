@@ -1,5 +1,9 @@
 from methods.abstract_methods.experiment import Experiment
-from methods.utils import timeit, cal_metrics
+from methods.utils import timeit, cal_metrics, get_classifier_predictions, get_max_batch_tokens, apply_cpu_precision, get_cpu_precision, get_model_variant
+from methods.compiled_inference import compile_model, is_compiled, load_pretrained
+from methods.onnx_inference import get_inference_backend, get_model_backend, load_onnx_model
+from methods.model_pool import load_from_pool
+from methods.tokenization_cache import tokenize_texts
 
 import evaluate
 import transformers
@@ -84,20 +88,11 @@ class SupervisedExperiment(Experiment):
         self.id2label = config.get("id2label", {0:"human", 1:"machine"})
         self.config = config
 
-    @timeit
-    def run(self):
-        start_time = time.time()
-        
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-            print(f"Using cache dir {self.cache_dir}")
-        if "cuda" in self.DEVICE and not torch.cuda.is_available():
-            print(f"Setting default device to cpu. Cuda is not available.")
-            self.DEVICE = "cpu"
-
-        print(f"Beginning supervised evaluation with {self.model}...")
-        detector = transformers.AutoModelForSequenceClassification.from_pretrained(
+    def load_detector_and_tokenizer(self):
+        detector = load_pretrained(
+            transformers.AutoModelForSequenceClassification,
             self.model,
+            self.config,
             num_labels=self.num_labels,
             cache_dir=self.cache_dir,
             ignore_mismatched_sizes=True,
@@ -119,7 +114,42 @@ class SupervisedExperiment(Experiment):
             detector.config.pad_token_id = tokenizer.get_vocab()[tokenizer.pad_token]
         except:
             print("Warning: Exception occured while setting pad_token_id")
+        # models to be finetuned are prepared for inference only after finetuning
+        if not self.finetune and self.bnb_quantization_config is None:
+            detector = self.prepare_for_inference(detector, tokenizer)
+        return detector, tokenizer
+
+    def prepare_for_inference(self, detector, tokenizer):
+        """
+        Export the detector to ONNX if the ONNX Runtime backend is enabled and the exported model passes the parity check
+        (on the train texts), otherwise convert it to the CPU precision and compile it (if enabled)
+        """
+        if get_inference_backend(self.config, self.DEVICE) != "pytorch":
+            onnx_detector = load_onnx_model(detector, tokenizer, self.config, self.data["train"]["text"])
+            if onnx_detector is not None:
+                return onnx_detector
+        detector = apply_cpu_precision(detector, self.config, self.DEVICE)
+        return compile_model(detector, self.config, self.DEVICE)
+
+    @timeit
+    def run(self):
+        start_time = time.time()
         
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            print(f"Using cache dir {self.cache_dir}")
+        if "cuda" in self.DEVICE and not torch.cuda.is_available():
+            print(f"Setting default device to cpu. Cuda is not available.")
+            self.DEVICE = "cpu"
+
+        print(f"Beginning supervised evaluation with {self.model}...")
+        if self.finetune:
+            # finetuning modifies the model, so it cannot be shared through the model pool
+            detector, tokenizer = self.load_detector_and_tokenizer()
+        else:
+            dtype = "bnb" if self.bnb_quantization_config is not None else get_model_variant(self.config, self.DEVICE)
+            detector, tokenizer = load_from_pool(
+                self.config, ("supervised", self.model, dtype, self.DEVICE, self.num_labels), self.load_detector_and_tokenizer)
 
         if self.finetune:
             fine_tune_model(
@@ -128,6 +158,8 @@ class SupervisedExperiment(Experiment):
                 tokenizer,
                 self.config
             )
+            if self.bnb_quantization_config is None:
+                detector = self.prepare_for_inference(detector, tokenizer)
 
         train_text = self.data["train"]["text"]
         train_label = self.data["train"]["label"]
@@ -146,6 +178,7 @@ class SupervisedExperiment(Experiment):
                 self.batch_size,
                 self.DEVICE,
                 self.pos_bit,
+                self.config,
             )
             test_preds = get_supervised_model_prediction(
                 detector,
@@ -154,6 +187,7 @@ class SupervisedExperiment(Experiment):
                 self.batch_size,
                 self.DEVICE,
                 self.pos_bit,
+                self.config,
             )
         else:
             train_preds = get_supervised_model_prediction_multi_classes(
@@ -163,6 +197,7 @@ class SupervisedExperiment(Experiment):
                 self.batch_size,
                 self.DEVICE,
                 self.pos_bit,
+                self.config,
             )
             test_preds = get_supervised_model_prediction_multi_classes(
                 detector,
@@ -171,6 +206,7 @@ class SupervisedExperiment(Experiment):
                 self.batch_size,
                 self.DEVICE,
                 self.pos_bit,
+                self.config,
             )
 
         y_train_pred_prob = train_preds
@@ -192,6 +228,8 @@ class SupervisedExperiment(Experiment):
             f"{self.model} acc_test: {acc_test}, precision_test: {precision_test}, recall_test: {recall_test}, f1_test: {f1_test}, auc_test: {auc_test}"
         )
 
+        inference_backend = get_model_backend(detector)
+
         # Clean up
         del detector
         gc.collect()
@@ -204,6 +242,9 @@ class SupervisedExperiment(Experiment):
             "predictions": {"train": y_train_pred, "test": y_test_pred},
             "machine_prob": {"train": y_train_pred_prob, "test": y_test_pred_prob},
             'running_time_seconds': time.time() - start_time,
+            'cpu_precision': get_cpu_precision(self.config, self.DEVICE),
+            'compiled': is_compiled(self.config),
+            'inference_backend': inference_backend,
             "metrics_results": {
                 "train": {
                     "acc": acc_train,
@@ -254,51 +295,20 @@ def set_pos_bit(model,model_output_machine_label: str, pos_bit: int) -> int:
 
 
 def get_supervised_model_prediction(
-    model, tokenizer, data, batch_size, DEVICE, pos_bit=0
+    model, tokenizer, data, batch_size, DEVICE, pos_bit=0, config=None
 ):
-    with torch.no_grad():
-        # get predictions for real
-        preds = []
-        for start in tqdm(range(0, len(data), batch_size), desc="Evaluating real"):
-            end = min(start + batch_size, len(data))
-            batch_data = data[start:end]
-            batch_data = tokenizer(
-                batch_data,
-                padding=True,
-                truncation=True,
-                max_length=512,
-                return_tensors="pt",
-            ).to(DEVICE)
-            preds.extend(model(**batch_data).logits.softmax(-1)[:, pos_bit].tolist())
-    return preds
+    # length-sorted batches of up to max_batch_tokens tokens, processed by worker processes if enabled in config
+    return get_classifier_predictions(model, tokenizer, data, lambda logits: logits.softmax(-1)[:, pos_bit].tolist(),
+                                      DEVICE, get_max_batch_tokens(config, batch_size), config, desc="Evaluating real")
 
 
 def get_supervised_model_prediction_multi_classes(
-    model, tokenizer, data, batch_size, DEVICE, pos_bit=0
+    model, tokenizer, data, batch_size, DEVICE, pos_bit=0, config=None
 ):
-    with torch.no_grad():
-        # get predictions for real
-        preds = []
-        for start in tqdm(range(0, len(data), batch_size), desc="Evaluating real"):
-            end = min(start + batch_size, len(data))
-            batch_data = data[start:end]
-            batch_data = tokenizer(
-                batch_data,
-                padding=True,
-                truncation=True,
-                max_length=512,
-                return_tensors="pt",
-            ).to(DEVICE)
-            preds.extend(torch.argmax(model(**batch_data).logits, dim=1).tolist())
-    return preds
-
-
-def preprocess_function(examples, **fn_kwargs):
-    return fn_kwargs['tokenizer'](examples["text"], 
-                                  padding=True,
-                                  truncation=True,
-                                  max_length=512)
-    
+    # length-sorted batches of up to max_batch_tokens tokens, processed by worker processes if enabled in config
+    return get_classifier_predictions(model, tokenizer, data, lambda logits: torch.argmax(logits, dim=1).tolist(),
+                                      DEVICE, get_max_batch_tokens(config, batch_size), config, desc="Evaluating real")
+
 
 def compute_metrics(eval_pred, metric_name="f1", average="micro"):
 
@@ -316,13 +326,9 @@ def fine_tune_model(data, model, tokenizer, config):
     data["label"] = data["label"].astype(int)
     data_train, data_val = train_test_split(data, test_size=0.2, stratify=data['label'], random_state=42)
 
-    # pandas dataframe to huggingface Dataset
-    train_dataset = Dataset.from_dict(data_train)
-    valid_dataset = Dataset.from_dict(data_val)
-
-    # tokenize data for train/valid
-    tokenized_train_dataset = train_dataset.map(preprocess_function, batched=True, fn_kwargs={'tokenizer': tokenizer})
-    tokenized_valid_dataset = valid_dataset.map(preprocess_function, batched=True,  fn_kwargs={'tokenizer': tokenizer})
+    # tokenize data for train/valid (through the tokenization cache if enabled) into huggingface Dataset
+    tokenized_train_dataset = Dataset.from_dict({**tokenize_texts(tokenizer, data_train["text"].tolist(), config), "label": data_train["label"].tolist()})
+    tokenized_valid_dataset = Dataset.from_dict({**tokenize_texts(tokenizer, data_val["text"].tolist(), config), "label": data_val["label"].tolist()})
 
     data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
 
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import time
+
+"""
+    Checkpointing of partial results of long-running loops inside an experiment
+    (e.g. criterion scores computed so far), so that an interrupted benchmark run can be resumed
+    where it stopped instead of starting the experiment over.
+"""
+
+DEFAULT_CHECKPOINT_INTERVAL = 600  # seconds
+
+
+def get_texts_hash(texts) -> str:
+    texts_hash = hashlib.sha1()
+    for text in texts:
+        texts_hash.update(text.encode("utf-8"))
+        texts_hash.update(b"\0")
+    return texts_hash.hexdigest()
+
+
+class JobCheckpoint:
+    def __init__(self, path, interval=DEFAULT_CHECKPOINT_INTERVAL, resume=True):
+        """
+        Args:
+            path (str): path to the JSON checkpoint file of a single (method, dataset) job
+            interval (float): minimal number of seconds between two writes of the checkpoint file
+            resume (bool): load partial results of a previous run from the checkpoint file, otherwise start from scratch
+        """
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+        self.partitions = {}
+        if resume and os.path.exists(path):
+            with open(path, "r") as file:
+                self.partitions = json.load(file)
+
+    def get(self, name, texts):
+        """
+        Return a dictionary mapping indices of texts to their values stored in partition name.
+        Values stored for a different list of texts are discarded.
+        """
+        texts_hash = get_texts_hash(texts)
+        partition = self.partitions.get(name)
+        if partition is None or partition["texts_hash"] != texts_hash:
+            partition = {"texts_hash": texts_hash, "values": {}}
+            self.partitions[name] = partition
+        elif partition["values"]:
+            print(f"Resuming {name} from checkpoint with {len(partition['values'])} of {len(texts)} values computed")
+        return {int(idx): value for idx, value in partition["values"].items()}
+
+    def update(self, name, values):
+        """Store values (dictionary mapping indices to JSON-compatible values) and save the checkpoint if it is due"""
+        self.partitions[name]["values"].update({str(idx): value for idx, value in values.items()})
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # write to a temporary file first, so that an interruption never leaves a corrupted checkpoint
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(self.partitions, file)
+        os.replace(self.path + ".tmp", self.path)
+        self.last_save = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,93 @@
+import traceback
+
+import torch
+import torch.nn.functional as F
+
+"""
+    Opt-in compiled inference of the scoring models.
+
+    Models are loaded with the SDPA attention implementation (if their architecture supports it) and wrapped
+    in CompiledModel, which runs the forward pass of the model compiled with torch.compile under torch.inference_mode.
+    To avoid recompiling the model for every new sequence length, inputs are padded to the nearest length bucket
+    and the outputs are cut back to the original length. If compilation or the compiled model fails,
+    the model falls back to eager execution.
+
+    Configured by the following items of the method config:
+        compiled - run the scoring models compiled (default false)
+        compile_length_buckets - sequence lengths the inputs are padded to, longer inputs are not padded
+"""
+
+DEFAULT_LENGTH_BUCKETS = (32, 64, 128, 256, 512)
+
+
+def is_compiled(config):
+    return config is not None and config.get("compiled", False)
+
+
+def load_pretrained(model_class, name, config=None, **kwargs):
+    """Load a pretrained model with model_class.from_pretrained, using the SDPA attention in the compiled mode if the architecture supports it"""
+    if is_compiled(config):
+        try:
+            return model_class.from_pretrained(name, attn_implementation="sdpa", **kwargs)
+        except (ValueError, ImportError):
+            print(f"WARNING: Model {name} does not support the SDPA attention implementation, using the default one.")
+    return model_class.from_pretrained(name, **kwargs)
+
+
+def compile_model(model, config, DEVICE):
+    """Wrap the model in CompiledModel if the compiled mode is enabled in config, otherwise return it unchanged"""
+    if not is_compiled(config):
+        return model
+    print(f"Compiling model {model.__class__.__name__}")
+    return CompiledModel(model, config.get("compile_length_buckets") or DEFAULT_LENGTH_BUCKETS)
+
+
+def get_length_bucket(length, buckets):
+    """Return the smallest bucket the sequence length fits into, or the length itself if it exceeds all buckets"""
+    return min((bucket for bucket in buckets if bucket >= length), default=length)
+
+
+class CompiledModel(torch.nn.Module):
+    def __init__(self, model, length_buckets=DEFAULT_LENGTH_BUCKETS):
+        super().__init__()
+        self.model = model
+        self.length_buckets = sorted(length_buckets)
+        self.eager = False
+        # not registered as a submodule, so that the parameters of the model are not listed twice
+        object.__setattr__(self, "compiled_model", torch.compile(model))
+
+    def __getattr__(self, name):
+        # everything but the forward pass (e.g. config, device or generate) is delegated to the original model
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self._modules["model"], name)
+
+    def forward(self, input_ids=None, attention_mask=None, **kwargs):
+        if self.eager:
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+
+        length = input_ids.shape[1]
+        padding = get_length_bucket(length, self.length_buckets) - length
+        pad_token_id = self.model.config.pad_token_id if self.model.config.pad_token_id is not None else 0
+        inputs = {"input_ids": F.pad(input_ids, (0, padding), value=pad_token_id)}
+        if attention_mask is not None:
+            inputs["attention_mask"] = F.pad(attention_mask, (0, padding), value=0)
+        for key, value in kwargs.items():
+            # other per-token inputs (e.g. token_type_ids) are padded as well
+            is_per_token = isinstance(value, torch.Tensor) and value.shape[:2] == input_ids.shape[:2]
+            inputs[key] = F.pad(value, (0, padding), value=0) if is_per_token else value
+
+        try:
+            with torch.inference_mode():
+                outputs = self.compiled_model(**inputs)
+        except Exception:
+            print("WARNING: Compiled model failed, falling back to eager execution. The failure was caused by:")
+            print(traceback.format_exc())
+            self.eager = True
+            return self.model(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+
+        # per-token logits of the padding are cut off, per-sequence logits (e.g. of classifiers) are kept
+        if outputs.logits.dim() == 3:
+            outputs["logits"] = outputs.logits[:, :length]
+        return outputs
@@ -1,5 +1,5 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
-from methods.utils import get_llm_deviation
+from methods.utils import llm_deviation_from_stats
 import torch
 import numpy as np
 
@@ -8,5 +8,5 @@ class LLMDeviationMetric(MetricBasedExperiment):
     def __init__(self, data, config):
         super().__init__(data, self.__class__.__name__, config)
     
-    def criterion_fn(self, text: str):
-        return np.array([get_llm_deviation(text, self.base_model, self.base_tokenizer, self.DEVICE)])
\ No newline at end of file
+    def criterion_from_token_stats(self, stats: dict):
+        return np.array([llm_deviation_from_stats(stats)])
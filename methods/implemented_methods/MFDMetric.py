@@ -1,13 +1,13 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
-from methods.utils import get_rank, get_ll, get_entropy, get_llm_deviation
+from methods.utils import llm_deviation_from_stats
 import numpy as np
 
 class MFDMetric(MetricBasedExperiment):
     def __init__(self, data, config):
         super().__init__(data, self.__class__.__name__, config)
     
-    def criterion_fn(self, text: str):
-        return np.array([get_rank(text, self.base_model, self.base_tokenizer, self.DEVICE, log=True),
-                get_ll(text, self.base_model, self.base_tokenizer, self.DEVICE),
-                get_entropy(text, self.base_model, self.base_tokenizer, self.DEVICE),
-                get_llm_deviation(text, self.base_model, self.base_tokenizer, self.DEVICE)])
\ No newline at end of file
+    def criterion_from_token_stats(self, stats: dict):
+        return np.array([stats["log_rank"].mean(),
+                stats["ll"].mean(),
+                stats["entropy"].mean(),
+                llm_deviation_from_stats(stats)])
@@ -1,4 +1,5 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
+from methods.compiled_inference import compile_model, load_pretrained
 import numpy as np
 
 from typing import Union
@@ -89,11 +90,12 @@ class Binoculars(object):
                  use_bfloat16: bool = True,
                  use_int4: bool = False,
                  max_token_observed: int = 512,
+                 config: dict = None,
                  ) -> None:
         if observer_name_or_path != performer_name_or_path:
           assert_tokenizer_consistency(observer_name_or_path, performer_name_or_path)
 
-        self.observer_model = AutoModelForCausalLM.from_pretrained(observer_name_or_path,
+        self.observer_model = load_pretrained(AutoModelForCausalLM, observer_name_or_path, config,
                                                                    device_map={"": DEVICE_1},
                                                                    trust_remote_code=True,
                                                                    torch_dtype=torch.bfloat16 if use_bfloat16
@@ -106,7 +108,7 @@ class Binoculars(object):
           DEVICE_2 = DEVICE_1
         else:
           DEVICE_2 = "cuda:1" if torch.cuda.device_count() > 1 else DEVICE_1
-          self.performer_model = AutoModelForCausalLM.from_pretrained(performer_name_or_path,
+          self.performer_model = load_pretrained(AutoModelForCausalLM, performer_name_or_path, config,
                                                                     device_map={"": DEVICE_2},
                                                                     trust_remote_code=True,
                                                                     torch_dtype=torch.bfloat16 if use_bfloat16
@@ -117,6 +119,11 @@ class Binoculars(object):
 
         self.observer_model.eval()
         self.performer_model.eval()
+        if self.performer_model is self.observer_model:
+          self.observer_model = self.performer_model = compile_model(self.observer_model, config, DEVICE_1)
+        else:
+          self.observer_model = compile_model(self.observer_model, config, DEVICE_1)
+          self.performer_model = compile_model(self.performer_model, config, DEVICE_2)
 
         self.tokenizer = AutoTokenizer.from_pretrained(observer_name_or_path, trust_remote_code=True)
         if not self.tokenizer.pad_token:
@@ -170,7 +177,7 @@ class BinocularsMetric(MetricBasedExperiment):
         self.config['observer'] = "tiiuae/falcon-7b"
         self.config['performer'] = "tiiuae/falcon-7b-instruct"
         self.config['int4'] = False
-        self.bino = Binoculars(observer_name_or_path=self.config['observer'], performer_name_or_path=self.config['performer'], use_int4=self.config['int4'])
+        self.bino = Binoculars(observer_name_or_path=self.config['observer'], performer_name_or_path=self.config['performer'], use_int4=self.config['int4'], config=self.config)
         
     def criterion_fn(self, text: str):
         results = [self.bino.predict(text)]
@@ -179,3 +186,9 @@ class BinocularsMetric(MetricBasedExperiment):
         if self.config['flipprobs']:
             probs = 1 - probs
         return probs
+
+    def criterion_batch_fn(self, texts: list):
+        probs = np.atleast_1d(np.array(self.bino.compute_score(texts)))
+        if self.config['flipprobs']:
+            probs = 1 - probs
+        return [np.array([prob]) for prob in probs]
@@ -1,5 +1,4 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
-from methods.utils import get_ll, get_rank
 
 import numpy as np
 
@@ -8,7 +7,6 @@ class DetectLLM_LLR(MetricBasedExperiment):
         super().__init__(data, self.__class__.__name__, config) # Set your own name or leave it set to the class name
         self.config = config
     
-    def criterion_fn(self, text: str):
-       return np.array([get_ll(text, self.base_model, self.base_tokenizer, self.DEVICE) \
-              / get_rank(text, self.base_model, self.base_tokenizer, self.DEVICE, log=True)])
+    def criterion_from_token_stats(self, stats: dict):
+       return np.array([stats["ll"].mean() / stats["log_rank"].mean()])
 
@@ -4,7 +4,7 @@ import transformers
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
-from methods.utils import get_clf_results, get_rank
+from methods.utils import get_clf_results
 
 class DetectLLM_NPR(PertubationBasedExperiment):
     
@@ -12,20 +12,16 @@ class DetectLLM_NPR(PertubationBasedExperiment):
         name = self.__class__.__name__
         super().__init__(data, name, config)
 
-    def get_score(self, text, perturbed_texts, base_model, base_tokenizer, DEVICE):
-        perturbed_ranks = get_ranks(perturbed_texts, base_model, base_tokenizer, DEVICE, log=True)
+    def score_from_token_stats(self, stats, perturbed_stats):
+        perturbed_ranks = [perturbed["log_rank"].mean().item() for perturbed in perturbed_stats]
         ranks_std = np.std(perturbed_ranks) if len(perturbed_ranks) > 1 else 1
         
         if ranks_std == 0:
             ranks_std = 1
             print("WARNING: std of perturbed original is 0, setting to 1")
             print(
-                f"Number of unique perturbed original texts: {len(set(text))}")
-            print(f"Original text: {text}")
+                f"Number of unique perturbed original log ranks: {len(set(perturbed_ranks))}")
         
         return np.array([np.mean(perturbed_ranks) / \
-               get_rank(text, base_model, base_tokenizer, DEVICE, log=True) / \
+               stats["log_rank"].mean().item() / \
                ranks_std])
-
-def get_ranks(texts, model, tokenizer, DEVICE, log=False):
-    return [get_rank(text, model, tokenizer, DEVICE, log) for text in texts]
\ No newline at end of file
@@ -7,7 +7,7 @@ import torch.nn.functional as F
 import random
 import time
 from tqdm import tqdm
-from methods.utils import get_clf_results, get_ll
+from methods.utils import get_clf_results
 
 class DetectGPT(PertubationBasedExperiment):
     
@@ -15,21 +15,14 @@ class DetectGPT(PertubationBasedExperiment):
         name = self.__class__.__name__
         super().__init__(data, name, config)
 
-    def get_score(self, text, perturbed_texts, base_model, base_tokenizer, DEVICE):
-        perturbed_lls = get_lls(perturbed_texts, base_model, base_tokenizer, DEVICE)
+    def score_from_token_stats(self, stats, perturbed_stats):
+        perturbed_lls = [perturbed["ll"].mean().item() for perturbed in perturbed_stats]
         lls_std = np.std(perturbed_lls) if len(perturbed_lls) > 1 else 1
         
         if lls_std == 0:
             lls_std = 1
             print("WARNING: std of perturbed original is 0, setting to 1")
             print(
-                f"Number of unique perturbed original texts: {len(set(text))}")
-            print(f"Original text: {text}")
+                f"Number of unique perturbed original log likelihoods: {len(set(perturbed_lls))}")
             
-        return np.array([(get_ll(text, base_model, base_tokenizer, DEVICE) - \
-                np.mean(get_lls(perturbed_texts, base_model, base_tokenizer, DEVICE))) / \
-                lls_std])
-                   
-
-def get_lls(texts, model, tokenizer, DEVICE):
-    return [get_ll(text, model, tokenizer, DEVICE) for text in texts]
\ No newline at end of file
+        return np.array([(stats["ll"].mean().item() - np.mean(perturbed_lls)) / lls_std])
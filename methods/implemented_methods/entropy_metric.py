@@ -1,5 +1,4 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
-from methods.utils import get_entropy
 
 import torch
 import torch.nn.functional as F
@@ -9,5 +8,5 @@ class EntropyMetric(MetricBasedExperiment):
     def __init__(self, data, config): # Add new arguments, if needed, e.g. base model, DEVICE
         super().__init__(data, self.__class__.__name__, config)
     
-    def criterion_fn(self, text: str):
-        return np.array([get_entropy(text, self.base_model, self.base_tokenizer, self.DEVICE)])
\ No newline at end of file
+    def criterion_from_token_stats(self, stats: dict):
+        return np.array([stats["entropy"].mean()])
@@ -0,0 +1,21 @@
+from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
+
+import numpy as np
+
+class FastDetectGPT(MetricBasedExperiment):
+    """
+    Analytic sampling discrepancy of Fast-DetectGPT (https://arxiv.org/abs/2310.05130), with the base model
+    used both as the sampling and the scoring model. Instead of perturbing the text, the log-likelihood
+    of the text is compared to its expectation and variance over tokens sampled from the model's own
+    predicted distributions, so it needs just a single forward pass of the base model.
+    """
+    def __init__(self, data, config):
+        super().__init__(data, self.__class__.__name__, config)
+    
+    def criterion_from_token_stats(self, stats: dict):
+        # expected log-likelihood of a sampled token is the negative entropy of the predicted distribution
+        expected_ll = -stats["entropy"].sum()
+        variance = stats["ll_var"].sum()
+        if variance <= 0:
+            return np.array([0.0])
+        return np.array([(stats["ll"].sum() - expected_ll) / np.sqrt(variance)])
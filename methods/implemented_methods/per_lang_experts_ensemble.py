@@ -1,5 +1,10 @@
 from methods.abstract_methods.experiment import Experiment
-from methods.utils import cal_metrics, timeit, move_model_to_device
+from methods.utils import cal_metrics, timeit, move_model_to_device, get_classifier_predictions, get_max_batch_tokens, \
+                          apply_cpu_precision, get_cpu_precision, get_model_variant
+from methods.compiled_inference import compile_model, is_compiled, load_pretrained
+from methods.onnx_inference import get_inference_backend, get_model_backend, load_onnx_model
+from methods.model_pool import load_from_pool
+from methods.tokenization_cache import tokenize_texts
 
 import transformers
 import evaluate
@@ -58,46 +63,57 @@ class PerLanguageExpertsEnsemble(Experiment):
         self.early_stopping = config.get("early_stopping", False)
         self.threshold_calibration = config.get("threshold_calibration", False)
         self.thresholds = config.get("thresholds", {})
+        # backends the experts were actually run with (see get_model_backend)
+        self.inference_backends = set()
 
      
      def get_predictions_for_multiple(self, data):
          if self.language_column not in data.keys():
              data[self.language_column] = [lang if (lang:=get_language(text)) in self.per_language_models.keys() else "unknown" for text in tqdm(data["text"], desc="Running language identification on input data")]
          languages = data[self.language_column]
-         weights = get_weights(languages, self.per_language_models)
-         results = []
-         for clf in self.load_models():
+         # each text is evaluated only by the model of its language, texts of languages without a model get probability 0
+         routes = get_language_routes(languages, self.per_language_models)
+         machine_prob = np.zeros(len(languages))
+         # probabilities of the texts each model has evaluated, None for the texts of other languages
+         preds_for_each_lang = {lang: [None] * len(languages) for lang in self.per_language_models.keys()}
+         for clf in self.load_models(routes.keys()):
              pos_bit = set_pos_bit(clf["model"], self.model_output_machine_label)
-             results.append(self.get_predictions_for_single(clf["name"], clf["model"], clf["tokenizer"], data["text"], pos_bit))
+             indices = routes[clf["name"]]
+             preds = self.get_predictions_for_single(clf["name"], clf["model"], clf["tokenizer"], [data["text"][idx] for idx in indices], pos_bit)
              free_model_memory(clf)
-         weighted_averages = np.multiply(np.array(weights).transpose(), np.array(results))
-         preds_for_each_lang = {lang:preds for lang, preds in zip(self.per_language_models.keys(), results)} 
-         return np.sum(weighted_averages, axis=0), preds_for_each_lang
+             for idx, pred in zip(indices, preds):
+                 machine_prob[idx] = pred
+                 preds_for_each_lang[clf["name"]][idx] = pred
+         return machine_prob, preds_for_each_lang
 
      def get_predictions_for_single(self, name, model, tokenizer, data, pos_bit):
-         with torch.no_grad():
-                preds = []
-                for start in tqdm(range(0, len(data),self.batch_size), desc=f"Evaluating data with language-specific model: {name}"):
-                    end = min(start + self.batch_size, len(data))
-                    batch_data = data[start:end]
-                    batch_data = tokenizer(
-                        batch_data,
-                        padding=True,
-                        truncation=True,
-                        max_length=512,
-                        return_tensors="pt",
-                    ).to(self.DEVICE)
-                    preds.extend(model(**batch_data).logits.softmax(-1)[:, pos_bit].tolist())
-
-         return preds
+         return get_classifier_predictions(model, tokenizer, data, lambda logits: logits.softmax(-1)[:, pos_bit].tolist(),
+                                           self.DEVICE, get_max_batch_tokens(self.config, self.batch_size), self.config,
+                                           desc=f"Evaluating data with language-specific model: {name}")
      
-     def load_models(self):
+     def load_models(self, languages=None):
+         """Load the models of the given languages (all by default) one after another"""
          for name, filepath in self.per_language_models.items():
-             model = transformers.AutoModelForSequenceClassification.from_pretrained(filepath, cache_dir=self.cache_dir)
-             tokenizer = transformers.AutoTokenizer.from_pretrained(filepath, cache_dir=self.cache_dir)
-             move_model_to_device(model, self.DEVICE)
+             if languages is not None and name not in languages:
+                 continue
+             model, tokenizer = load_from_pool(self.config, ("ensemble", filepath, get_model_variant(self.config, self.DEVICE), self.DEVICE),
+                                               lambda: self.load_model_and_tokenizer(filepath))
+             self.inference_backends.add(get_model_backend(model))
              yield {"name": name, "model": model, "tokenizer": tokenizer}
 
+     def load_model_and_tokenizer(self, filepath):
+         model = load_pretrained(transformers.AutoModelForSequenceClassification, filepath, self.config, cache_dir=self.cache_dir)
+         tokenizer = transformers.AutoTokenizer.from_pretrained(filepath, cache_dir=self.cache_dir)
+         move_model_to_device(model, self.DEVICE)
+         # experts failing the parity check (on the train texts) are run by PyTorch
+         if get_inference_backend(self.config, self.DEVICE) != "pytorch":
+             onnx_model = load_onnx_model(model, tokenizer, self.config, self.data["train"]["text"])
+             if onnx_model is not None:
+                 return onnx_model, tokenizer
+         model = apply_cpu_precision(model, self.config, self.DEVICE)
+         model = compile_model(model, self.config, self.DEVICE)
+         return model, tokenizer
+
     
      def finetune(self):
          ID2LABEL = {0: "human", 1: "machine"}
@@ -141,17 +157,42 @@ class PerLanguageExpertsEnsemble(Experiment):
          gc.collect()
          torch.cuda.empty_cache()
     
+     def get_unknown_predictions(self, data, preds_for_each_lang):
+         """
+         Return a copy of preds_for_each_lang (see get_predictions_for_multiple), in which the model for unknown languages
+         has evaluated all texts, not only the texts routed to it, as its threshold is calibrated on the whole dataset
+         """
+         preds_for_each_lang = {lang: list(preds) for lang, preds in preds_for_each_lang.items()}
+         if "unknown" not in preds_for_each_lang:
+             return preds_for_each_lang
+         missing = [idx for idx, pred in enumerate(preds_for_each_lang["unknown"]) if pred is None]
+         if not missing:
+             return preds_for_each_lang
+         for clf in self.load_models(["unknown"]):
+             pos_bit = set_pos_bit(clf["model"], self.model_output_machine_label)
+             preds = self.get_predictions_for_single(clf["name"], clf["model"], clf["tokenizer"], [data["text"][idx] for idx in missing], pos_bit)
+             free_model_memory(clf)
+             for idx, pred in zip(missing, preds):
+                 preds_for_each_lang["unknown"][idx] = pred
+         return preds_for_each_lang
+
      def calibrate_thresholds(self, metrics_per_lang):
          df_metrics = pd.DataFrame(metrics_per_lang)
          df_metrics = df_metrics.add_prefix("language-pred-prob-")
          data = pd.concat([pd.DataFrame(self.data["train"]), df_metrics], axis="columns")
          language_splits = split_by_language(pd.DataFrame(data), self.language_column, self.per_language_models)
-         language_splits["unknown"] = data # Whole dataset for training of the multilingual detector for unknown languages
+         language_splits["unknown"] = data # Whole dataset for the multilingual detector for unknown languages (scored on all texts, see get_unknown_predictions)
          optimal_thresholds = {}
          print(data)
          for lang, df in language_splits.items():
              if lang not in self.per_language_models.keys():
                  continue
+             # only the texts evaluated by the model of the language (see get_predictions_for_multiple)
+             df = df.dropna(subset=["language-pred-prob-"+lang])
+             # the ROC curve is undefined for a single class, such languages keep the default threshold
+             if df["label"].nunique() < 2:
+                 print(f"WARNING: Texts of language {lang} do not contain both classes, using the default threshold {DEFAULT_THRESHOLD}.")
+                 continue
              fpr, tpr, thresholds = roc_curve(df["label"], df["language-pred-prob-"+lang])
              th_optim_idx = np.argmax(tpr - fpr)
              th_optim2_idx = np.argmin(np.abs(fpr+tpr-1))
@@ -165,6 +206,7 @@ class PerLanguageExpertsEnsemble(Experiment):
      @timeit
      def run(self):
         start_time = time.time()
+        self.inference_backends = set()
         
         if not self.do_finetune and "unknown" not in self.per_language_models.keys():
             raise ValueError("No language model specified for language 'unknown'. When not finetuning and running only inference, please specify all per-language models for each language explicitly in config.")
@@ -199,7 +241,7 @@ class PerLanguageExpertsEnsemble(Experiment):
 
         if self.threshold_calibration:
             print("Running threshold calibration")
-            self.calibrate_thresholds(machine_prob_by_lang_train)
+            self.calibrate_thresholds(self.get_unknown_predictions(train_data, machine_prob_by_lang_train))
             print("Thresholds:", self.thresholds)
 
         test_data = self.data['test']
@@ -225,6 +267,10 @@ class PerLanguageExpertsEnsemble(Experiment):
             'machine_prob': {'train': y_train_pred_prob.tolist(), 'test': y_test_pred_prob.tolist()},
             'machine_prob_by_lang': {'train': machine_prob_by_lang_train, 'test': machine_prob_by_lang_test},
             'running_time_seconds': time.time() - start_time,
+            'cpu_precision': get_cpu_precision(self.config, self.DEVICE),
+            'compiled': is_compiled(self.config),
+            # experts run by different backends are reported together, e.g. onnx+pytorch
+            'inference_backend': "+".join(sorted(self.inference_backends)) or "pytorch",
             'metrics_results': {
                 'train': {
                     'acc': acc_train,
@@ -286,15 +332,13 @@ def get_language(text):
     return 'unknown'
 
 
-def get_weights(languages, per_language_models):
-    return [[1 if model_lang == lang else 0 for model_lang in per_language_models.keys()] for lang in languages]
-
-
-def preprocess_function(examples, **fn_kwargs):
-    return fn_kwargs['tokenizer'](examples["text"], 
-                                  padding=True,
-                                  truncation=True,
-                                  max_length=512,)
+def get_language_routes(languages, per_language_models):
+    """Return a dictionary mapping each language with a model to the indices of its texts (only languages having some texts)"""
+    routes = {}
+    for idx, lang in enumerate(languages):
+        if lang in per_language_models:
+            routes.setdefault(lang, []).append(idx)
+    return routes
 
 
 def compute_metrics(eval_pred, metric_name="f1", average="micro"):
@@ -315,13 +359,9 @@ def finetune_model(data, model, tokenizer, config):
     data["label"] = data["label"].astype(int)
     data_train, data_val = sklearn.model_selection.train_test_split(data, test_size=0.2, stratify=data['label'], random_state=42)
 
-    # pandas dataframe to huggingface Dataset
-    train_dataset = datasets.Dataset.from_dict(data_train)
-    valid_dataset = datasets.Dataset.from_dict(data_val)
-
-    # tokenize data for train/valid
-    tokenized_train_dataset = train_dataset.map(preprocess_function, batched=True, fn_kwargs={'tokenizer': tokenizer})
-    tokenized_valid_dataset = valid_dataset.map(preprocess_function, batched=True,  fn_kwargs={'tokenizer': tokenizer})
+    # tokenize data for train/valid (through the tokenization cache if enabled) into huggingface Dataset
+    tokenized_train_dataset = datasets.Dataset.from_dict({**tokenize_texts(tokenizer, data_train["text"].tolist(), config["global_config"]), "label": data_train["label"].tolist()})
+    tokenized_valid_dataset = datasets.Dataset.from_dict({**tokenize_texts(tokenizer, data_val["text"].tolist(), config["global_config"]), "label": data_val["label"].tolist()})
 
     data_collator = transformers.DataCollatorWithPadding(tokenizer=tokenizer)
     callbacks = []
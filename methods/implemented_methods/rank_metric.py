@@ -1,5 +1,4 @@
 from methods.abstract_methods.metric_based_experiment import MetricBasedExperiment
-from methods.utils import get_rank
 import torch
 import numpy as np
 
@@ -9,5 +8,5 @@ class RankMetric(MetricBasedExperiment):
     def __init__(self, data, config): # Add new arguments, if needed, e.g. base model, DEVICE
         super().__init__(data, self.__class__.__name__, config)
     
-    def criterion_fn(self, text: str):
-        return np.array([get_rank(text, self.base_model, self.base_tokenizer, self.DEVICE)])
\ No newline at end of file
+    def criterion_from_token_stats(self, stats: dict):
+        return np.array([stats["rank"].mean()])
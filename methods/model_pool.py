@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import gc
+
+import torch
+
+from methods.onnx_inference import OnnxClassifier
+
+"""
+    Process-wide pool of loaded models, so that experiments running one after another
+    in the same benchmark run can share model and tokenizer instances instead of loading them again.
+
+    Models are kept resident until the total size of the pooled models exceeds the configured
+    memory budget, in which case the least recently used models are evicted from the pool.
+    Pooled models are shared, so experiments must not modify them (e.g. by finetuning).
+"""
+
+BYTES_IN_GB = 1024 ** 3
+
+
+def get_model_size(model) -> int:
+    """Return the number of bytes occupied by the parameters and buffers of a model (or the weights of an ONNX model)"""
+    if isinstance(model, OnnxClassifier):
+        return model.get_size()
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(model.parameters()) + list(model.buffers()))
+
+
+class ModelPool:
+    def __init__(self):
+        self.entries = OrderedDict()  # key -> (loaded objects, size in bytes)
+
+    def get(self, key, loader, max_memory_gb=None):
+        """
+        Get objects (e.g. a model and its tokenizer) stored in the pool under the given key,
+        or load them with the loader and store them in the pool.
+
+        Args:
+            key (tuple): identifier of the model, e.g. (loader type, model name, dtype, device)
+            loader (callable): function without arguments returning the model (or a tuple with the model first)
+            max_memory_gb (float): memory budget of the whole pool, None for unlimited
+
+        Returns whatever the loader returns
+        """
+        if key in self.entries:
+            print(f"Reusing model {key[1]} from the model pool")
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        loaded = loader()
+        model = loaded[0] if isinstance(loaded, tuple) else loaded
+        size = get_model_size(model)
+        max_memory = max_memory_gb * BYTES_IN_GB if max_memory_gb is not None else None
+        if max_memory is not None and size > max_memory:
+            print(f"Model {key[1]} ({size / BYTES_IN_GB:.2f} GB) does not fit into the model pool memory budget, not pooling it")
+            return loaded
+
+        while max_memory is not None and self.entries and self.get_memory_usage() + size > max_memory:
+            evicted_key = next(iter(self.entries))
+            print(f"Evicting model {evicted_key[1]} from the model pool")
+            self.evict(evicted_key)
+
+        self.entries[key] = (loaded, size)
+        return loaded
+
+    def get_memory_usage(self) -> int:
+        return sum(size for _, size in self.entries.values())
+
+    def evict(self, key):
+        del self.entries[key]
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def retain(self, required):
+        """Evict all pooled models, except those whose (loader type, model name) is in required"""
+        for key in list(self.entries.keys()):
+            if key[:2] not in required:
+                self.evict(key)
+
+    def clear(self):
+        for key in list(self.entries.keys()):
+            self.evict(key)
+
+
+MODEL_POOL = ModelPool()
+
+
+def load_from_pool(config, key, loader):
+    """Load objects through the process-wide model pool if enabled in config, otherwise just call the loader"""
+    if not config.get("model_pool", False):
+        return loader()
+    return MODEL_POOL.get(key, loader, config.get("model_pool_memory_gb"))
+
+
+def release_from_pool(config, key):
+    """Evict objects stored under the given key from the process-wide model pool (if enabled in config), so that they can be freed"""
+    if config.get("model_pool", False) and key in MODEL_POOL.entries:
+        MODEL_POOL.evict(key)
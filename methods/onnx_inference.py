@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+"""
+    ONNX Runtime backend of the sequence classification models (supervised detectors and per-language experts).
+
+    A model is exported to ONNX once and stored in the cache_dir, optionally with its linear layers dynamically
+    quantized to int8 by ONNX Runtime. The exported models are identified by the model name and a hash of its weights,
+    so that finetuned checkpoints of the same model get their own export. Inference then runs through ONNX Runtime
+    on CPU by OnnxClassifier, which is called like the PyTorch model, so the tokenization and batching of the PyTorch
+    backend are kept. Before an exported model is used, its outputs are compared with those of the PyTorch model
+    and if they differ by more than the tolerance, the PyTorch model is used instead. Results report the backend
+    the models were actually run with (see get_model_backend).
+
+    Configured by the following items of the method config:
+        inference_backend - "pytorch" (default) or "onnx" (CPU only)
+        onnx_quantize - quantize the exported model to int8
+        onnx_parity_texts - number of texts (of the train data) the ONNX and PyTorch outputs are compared on
+        onnx_parity_tolerance - maximal allowed difference of the output probabilities
+"""
+
+INFERENCE_BACKENDS = ("pytorch", "onnx")
+
+ONNX_OPSET = 17
+
+
+def get_inference_backend(config, DEVICE):
+    """Return the name of the backend sequence classification models are run with: pytorch, onnx or onnx-int8"""
+    backend = config.get("inference_backend", "pytorch") if config is not None else "pytorch"
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend}, choose one of {', '.join(INFERENCE_BACKENDS)}")
+    if backend == "pytorch":
+        return backend
+    if "cpu" not in DEVICE:
+        print(f"WARNING: The ONNX Runtime backend runs only on CPU, running models on {DEVICE} with PyTorch.")
+        return "pytorch"
+    return "onnx-int8" if config.get("onnx_quantize", False) else "onnx"
+
+
+def get_model_hash(model) -> str:
+    """Return a hash of the configuration and weights of a model"""
+    sha = hashlib.sha1(model.config.to_json_string().encode("utf-8"))
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode("utf-8"))
+        sha.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+class _LogitsModel(torch.nn.Module):
+    """Model with positional inputs returning only the logits, as expected by the ONNX export"""
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).logits
+
+
+def export_onnx(model, tokenizer, cache_dir, quantize=False):
+    """
+    Export a sequence classification model to ONNX in cache_dir (if it is not exported yet).
+
+    Returns the path to the exported model (quantized, if quantize is True)
+    """
+    name = (model.config.name_or_path or model.__class__.__name__).strip("/").replace("/", "-")
+    path = os.path.join(cache_dir, "onnx", f"{name}-{get_model_hash(model)[:16]}")
+    model_path = os.path.join(path, "model.onnx")
+    if not os.path.exists(model_path):
+        print(f"Exporting model {name} to ONNX")
+        os.makedirs(path, exist_ok=True)
+        # batch of texts of different lengths, so that the padding is traced as well
+        dummy = tokenizer(["Exported text.", "A longer text exported to ONNX with padding."], padding=True, return_tensors="pt")
+        input_names = [input_name for input_name in tokenizer.model_input_names if input_name in dummy]
+        dynamic_axes = {input_name: {0: "batch", 1: "sequence"} for input_name in input_names}
+        dynamic_axes["logits"] = {0: "batch"}
+        # export has to be traced in the inference mode, otherwise dropout ends up in the exported model
+        logits_model = _LogitsModel(model, input_names).eval()
+        with torch.no_grad():
+            torch.onnx.export(logits_model, tuple(dummy[input_name].to(model.device) for input_name in input_names), model_path + ".tmp",
+                              input_names=input_names, output_names=["logits"], dynamic_axes=dynamic_axes,
+                              opset_version=ONNX_OPSET, dynamo=False)
+        os.replace(model_path + ".tmp", model_path)
+        with open(os.path.join(path, "model.json"), "w") as file:
+            json.dump({"name": model.config.name_or_path, "input_names": input_names, "opset": ONNX_OPSET}, file)
+    if not quantize:
+        return model_path
+
+    quantized_path = os.path.join(path, "model-int8.onnx")
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"Quantizing ONNX model {name} to int8")
+        quantize_dynamic(model_path, quantized_path + ".tmp", weight_type=QuantType.QInt8)
+        os.replace(quantized_path + ".tmp", quantized_path)
+    return quantized_path
+
+
+class OnnxClassifier:
+    """
+    Sequence classification model run by ONNX Runtime, called with the same (PyTorch) inputs as the original model.
+    Sessions are not shared with forked worker processes, each process creates its own one on the first call.
+    """
+    def __init__(self, path, config, backend="onnx"):
+        self.path = path
+        self.config = config
+        self.backend = backend
+        self.session = None
+        self.pid = None
+
+    def get_session(self):
+        if self.session is None or self.pid != os.getpid():
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+            self.pid = os.getpid()
+        return self.session
+
+    def __call__(self, **inputs):
+        session = self.get_session()
+        feeds = {model_input.name: inputs[model_input.name].cpu().numpy().astype(np.int64) for model_input in session.get_inputs()}
+        logits = session.run(["logits"], feeds)[0]
+        return SequenceClassifierOutput(logits=torch.from_numpy(logits))
+
+    def eval(self):
+        return self
+
+    def get_size(self):
+        """Return the number of bytes occupied by the weights (initializers) of the exported model"""
+        import onnx
+        graph = onnx.load(self.path, load_external_data=False).graph
+        return sum(int(np.prod(tensor.dims, dtype=np.int64)) * onnx.helper.tensor_dtype_to_np_dtype(tensor.data_type).itemsize
+                   for tensor in graph.initializer)
+
+
+def get_model_backend(model):
+    """Return the backend a loaded model is run with: onnx or onnx-int8 for OnnxClassifier, pytorch otherwise"""
+    return model.backend if isinstance(model, OnnxClassifier) else "pytorch"
+
+
+def get_onnx_parity(model, onnx_model, tokenizer, texts, max_length=512):
+    """Return the maximal difference of the output probabilities of the PyTorch and the ONNX model on the texts"""
+    inputs = tokenizer(list(texts), padding=True, truncation=True, max_length=max_length, return_tensors="pt")
+    with torch.no_grad():
+        expected = model(**inputs.to(model.device)).logits.float().softmax(-1).cpu()
+    actual = onnx_model(**inputs).logits.float().softmax(-1)
+    return (expected - actual).abs().max().item()
+
+
+def load_onnx_model(model, tokenizer, config, parity_texts):
+    """
+    Export the model to ONNX (if not exported yet) and return it as OnnxClassifier, if its outputs on the first
+    onnx_parity_texts of parity_texts match the outputs of the PyTorch model, otherwise return None,
+    so that the caller prepares the PyTorch model as usual.
+    """
+    quantize = config.get("onnx_quantize", False)
+    onnx_model = OnnxClassifier(export_onnx(model, tokenizer, config["cache_dir"], quantize), model.config, "onnx-int8" if quantize else "onnx")
+    parity_texts = list(parity_texts)[:config.get("onnx_parity_texts", 16)]
+    if not parity_texts:
+        return onnx_model
+    difference = get_onnx_parity(model, onnx_model, tokenizer, parity_texts)
+    tolerance = config.get("onnx_parity_tolerance", 0.01)
+    print(f"ONNX parity check: maximal difference of probabilities on {len(parity_texts)} texts is {difference:.2e} (tolerance {tolerance})")
+    if difference > tolerance:
+        print(f"WARNING: Outputs of the ONNX model {onnx_model.path} differ from the PyTorch model, running the PyTorch model instead.")
+        return None
+    return onnx_model
@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import queue
+import traceback
+
+import torch
+
+"""
+    Data-parallel execution of scoring loops on CPU.
+
+    Tasks (e.g. batches of texts) are distributed among worker processes, which are forked from the current
+    process, so that they share the already loaded models with it instead of loading their own copies
+    (the weights are only read by the workers, so their copy-on-write pages are never copied).
+    Each worker uses its own share of the CPU threads. Results are returned in the order of the tasks,
+    as if the tasks were processed sequentially.
+
+    Configured by the following items of the method config:
+        n_workers - number of worker processes, 1 (default) disables the data-parallel execution
+        threads_per_worker - number of torch threads of each worker, by default the CPU cores are split evenly among the workers
+
+    It also provides a producer process (iterate_producer_process), which runs one stage of a pipeline
+    with its own torch threads and passes its outputs to the next stage in this process through a bounded queue.
+"""
+
+# Function applied to the tasks by the workers. It is inherited through fork, so it does not need to be picklable.
+_WORKER_FN = None
+
+
+def get_n_workers(config, DEVICE):
+    """Return the number of worker processes to be used, 1 if the data-parallel execution is not possible"""
+    n_workers = config.get("n_workers", 1) if config is not None else 1
+    if n_workers <= 1 or not can_fork(DEVICE):
+        return 1
+    return n_workers
+
+
+def get_threads_per_worker(config, n_workers):
+    threads_per_worker = config.get("threads_per_worker")
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+    return threads_per_worker
+
+
+def _init_worker(threads_per_worker):
+    torch.set_num_threads(threads_per_worker)
+
+
+def _run_task(task):
+    with torch.no_grad():
+        return _WORKER_FN(task)
+
+
+def imap_data_parallel(fn, tasks, config, DEVICE):
+    """
+    Lazily apply fn to each of the tasks, in worker processes if enabled in config.
+
+    Args:
+        fn (callable): function applied to a single task, its result has to be picklable
+        tasks (list): picklable tasks, e.g. lists of texts
+        config (dict): method config with the n_workers and threads_per_worker items
+        DEVICE (str): device the models are on, only CPU models are run in worker processes
+
+    Yields results of fn in the order of tasks
+    """
+    n_workers = min(get_n_workers(config, DEVICE), len(tasks))
+    if n_workers <= 1:
+        for task in tasks:
+            yield fn(task)
+        return
+
+    global _WORKER_FN
+    _WORKER_FN = fn
+    context = multiprocessing.get_context("fork")
+    try:
+        with context.Pool(n_workers, initializer=_init_worker, initargs=(get_threads_per_worker(config, n_workers),)) as pool:
+            yield from pool.imap(_run_task, tasks)
+    finally:
+        _WORKER_FN = None
+
+
+def map_data_parallel(fn, tasks, config, DEVICE):
+    """Same as imap_data_parallel, but returns the list of all results"""
+    return list(imap_data_parallel(fn, tasks, config, DEVICE))
+
+
+def can_fork(DEVICE):
+    """Return whether models on DEVICE can be used by forked processes"""
+    return "cpu" in DEVICE and "fork" in multiprocessing.get_all_start_methods()
+
+
+def _run_producer(produce, output_queue, threads):
+    torch.set_num_threads(threads)
+    try:
+        with torch.no_grad():
+            produce(lambda item: output_queue.put(("item", item)))
+        output_queue.put(("done", None))
+    except BaseException:
+        output_queue.put(("error", traceback.format_exc()))
+
+
+def iterate_producer_process(produce, queue_size, threads):
+    """
+    Run produce in a forked process with the given number of torch threads and yield the items it produces.
+
+    Args:
+        produce (callable): function taking a single argument, the function to be called with each produced (picklable) item
+        queue_size (int): maximal number of produced items waiting to be consumed, the producer is blocked beyond it
+        threads (int): number of torch threads of the producer process
+    """
+    context = multiprocessing.get_context("fork")
+    output_queue = context.Queue(maxsize=queue_size)
+    process = context.Process(target=_run_producer, args=(produce, output_queue, threads), daemon=True)
+    process.start()
+    try:
+        while True:
+            try:
+                kind, item = output_queue.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"Producer process exited unexpectedly with exit code {process.exitcode}")
+                continue
+            if kind == "done":
+                break
+            if kind == "error":
+                raise RuntimeError(f"Producer process failed with the following exception:\n{item}")
+            yield item
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+
+"""
+    Persistent store of the perturbed texts generated by the perturbation-based methods.
+
+    Perturbations are identified by the hash of the original text and the perturbation round, and stored
+    separately for each combination of the mask filling model and perturbation parameters (see get_store_key),
+    so that any perturbation-based method and any later run with the same parameters can reuse them
+    instead of generating them again.
+
+    Perturbed texts are appended to a single UTF-8 text file (each unique text is written only once,
+    the original texts are not stored at all), the index of offsets of the perturbations of each original text
+    is appended to a JSON lines file as new perturbations are generated.
+"""
+
+STORE_VERSION = 1
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_store_key(config, seed, fill_dictionary=None):
+    """Return parameters of the perturbation process, which identify the perturbations in the store"""
+    if config["random_fills"] and config["random_fills_tokens"]:
+        mask_model = "random_fills_tokens-" + config["base_model_name"]
+    elif config["random_fills"]:
+        # random words are sampled from the words of the dataset
+        mask_model = "random_fills-" + hashlib.sha1("\n".join(fill_dictionary).encode("utf-8")).hexdigest()[:16]
+    else:
+        mask_model = config["mask_filling_model_name"]
+    return {
+        "version": STORE_VERSION,
+        "mask_model": mask_model,
+        "pct_words_masked": config["pct_words_masked"],
+        "span_length": config["span_length"],
+        "buffer_size": config["buffer_size"],
+        "mask_top_p": config["mask_top_p"],
+        "seed": seed,
+    }
+
+
+class PerturbationStore:
+    def __init__(self, cache_dir, config, seed=0, fill_dictionary=None):
+        key = get_store_key(config, seed, fill_dictionary)
+        dirname = key["mask_model"].replace("/", "-") + "-" + hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, "perturbations", dirname)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, "key.json"), "w") as file:
+                json.dump(key, file, sort_keys=True)
+
+        self.index = {}  # (hash of the original text, round) -> list of (offset, length) of its perturbed texts
+        self.offsets = {}  # hash of a perturbed text -> (offset, length), for texts written or read by this process
+        size = 0
+        index_path = os.path.join(self.path, "index.jsonl")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.index[(entry["hash"], entry["round"])] = [tuple(item) for item in entry["texts"]]
+                    size = max([size] + [offset + length for offset, length in entry["texts"]])
+        # drop texts written by an interrupted add() that did not make it to the index
+        with open(self._texts_path(), "ab") as file:
+            file.truncate(size)
+        self.size = size
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, text, round_idx=0):
+        """Return the list of stored perturbations of the original text in the given round (empty if there are none)"""
+        entries = self.index.get((get_text_hash(text), round_idx), [])
+        if not entries:
+            return []
+        perturbed_texts = []
+        with open(self._texts_path(), "rb") as file:
+            for offset, length in entries:
+                file.seek(offset)
+                perturbed_text = file.read(length).decode("utf-8")
+                self.offsets[get_text_hash(perturbed_text)] = (offset, length)
+                perturbed_texts.append(perturbed_text)
+        return perturbed_texts
+
+    def add(self, texts, round_idx, perturbed_texts):
+        """
+        Store perturbations of the original texts in the given round.
+
+        Args:
+            texts (list[str]): original texts
+            round_idx (int): perturbation round
+            perturbed_texts (list[list[str]]): all perturbations of each original text generated so far,
+                                               they replace the previously stored ones
+        """
+        entries = []
+        with open(self._texts_path(), "ab") as file:
+            for text, text_perturbations in zip(texts, perturbed_texts):
+                items = []
+                for perturbed_text in text_perturbations:
+                    perturbed_hash = get_text_hash(perturbed_text)
+                    if perturbed_hash not in self.offsets:
+                        data = perturbed_text.encode("utf-8")
+                        file.write(data)
+                        self.offsets[perturbed_hash] = (self.size, len(data))
+                        self.size += len(data)
+                    items.append(self.offsets[perturbed_hash])
+                self.index[(get_text_hash(text), round_idx)] = items
+                entries.append(json.dumps({"hash": get_text_hash(text), "round": round_idx, "texts": items}))
+        # index is written only after the texts themselves, so it never points past the end of the text file
+        if entries:
+            with open(os.path.join(self.path, "index.jsonl"), "a") as index_file:
+                index_file.write("\n".join(entries) + "\n")
+
+    def _texts_path(self):
+        return os.path.join(self.path, "texts.txt")
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from methods.utils import get_token_stats, make_token_stats
+
+"""
+    Persistent archive of the per-token statistics of the base model (see get_token_stats in methods/utils.py).
+
+    Statistics of all texts are stored in one flat (ragged) binary file per statistic, together with
+    an index mapping the hash of each text to its position in these files. The files are only appended to,
+    and memory-mapped for reading. One archive is kept for each combination of base model, tokenizer, max_length
+    and model variant (CPU precision, compilation, see get_model_variant in methods/utils.py) in the cache_dir, so that repeated runs (and different metric-based methods) can share
+    the statistics without another forward pass of the base model.
+"""
+
+ARCHIVE_VERSION = 1
+
+# Statistics that are stored in the archive, the rest is derived from them by make_token_stats
+ARCHIVE_FIELDS = {
+    "ll": np.float16,
+    "rank": np.int32,
+    "entropy": np.float16,
+    "ll_var": np.float16,
+}
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class TokenStatsArchive:
+    def __init__(self, cache_dir, model_name, tokenizer_name, max_length=512, variant="float32"):
+        key = json.dumps({"version": ARCHIVE_VERSION,
+                          "model": model_name,
+                          "variant": variant,
+                          "tokenizer": tokenizer_name,
+                          "max_length": max_length,
+                          "fields": {name: np.dtype(dtype).str for name, dtype in ARCHIVE_FIELDS.items()}},
+                         sort_keys=True)
+        dirname = model_name.replace("/", "-") + "-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, "token_stats", dirname)
+        self.max_length = max_length
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, "key.json"), "w") as file:
+                file.write(key)
+
+        self.index = {}
+        self.n_tokens = 0
+        index_path = os.path.join(self.path, "index.jsonl")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.index[entry["hash"]] = (entry["offset"], entry["length"])
+                    self.n_tokens = max(self.n_tokens, entry["offset"] + entry["length"])
+        # drop statistics written by an interrupted add() that did not make it to the index
+        for name, dtype in ARCHIVE_FIELDS.items():
+            with open(self._field_path(name), "ab") as file:
+                file.truncate(self.n_tokens * np.dtype(dtype).itemsize)
+        self._maps = {}
+
+    def __contains__(self, text):
+        return get_text_hash(text) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def contains_all(self, texts):
+        return all(text in self for text in texts)
+
+    def get(self, text):
+        """Return the per-token statistics of an archived text or None, if the text is not archived"""
+        entry = self.index.get(get_text_hash(text))
+        if entry is None:
+            return None
+        offset, length = entry
+        arrays = {name: np.array(self._map(name)[offset:offset + length]) for name in ARCHIVE_FIELDS}
+        return make_token_stats(ll=arrays["ll"].astype(np.float32),
+                                rank=arrays["rank"].astype(np.int64),
+                                entropy=arrays["entropy"].astype(np.float32),
+                                ll_var=arrays["ll_var"].astype(np.float32))
+
+    def add(self, texts, stats):
+        """Append the per-token statistics of texts to the archive (already archived texts are skipped)"""
+        entries = []
+        files = {name: open(self._field_path(name), "ab") for name in ARCHIVE_FIELDS}
+        try:
+            for text, text_stats in zip(texts, stats):
+                text_hash = get_text_hash(text)
+                if text_hash in self.index:
+                    continue
+                for name, dtype in ARCHIVE_FIELDS.items():
+                    files[name].write(np.asarray(text_stats[name], dtype=dtype).tobytes())
+                length = len(text_stats["rank"])
+                self.index[text_hash] = (self.n_tokens, length)
+                entries.append(json.dumps({"hash": text_hash, "offset": self.n_tokens, "length": length}))
+                self.n_tokens += length
+        finally:
+            for file in files.values():
+                file.close()
+        # index is written only after the statistics themselves, so it never points past the end of the files
+        if entries:
+            with open(os.path.join(self.path, "index.jsonl"), "a") as index_file:
+                index_file.write("\n".join(entries) + "\n")
+        # files have grown, so they have to be mapped again
+        self._maps = {}
+
+    def get_token_stats(self, texts, model, tokenizer, DEVICE):
+        """
+        Same as get_token_stats in methods/utils.py, but only the texts that are not archived yet are
+        passed through the model. All returned statistics are read from the archive.
+        """
+        missing = list(dict.fromkeys(text for text in texts if text not in self))
+        if missing:
+            self.add(missing, get_token_stats(missing, model, tokenizer, DEVICE, max_length=self.max_length))
+        return [self.get(text) for text in texts]
+
+    def _field_path(self, name):
+        return os.path.join(self.path, f"{name}.bin")
+
+    def _map(self, name):
+        if name not in self._maps:
+            if os.path.getsize(self._field_path(name)) == 0:
+                # empty files cannot be memory-mapped
+                return np.empty(0, dtype=ARCHIVE_FIELDS[name])
+            self._maps[name] = np.memmap(self._field_path(name), dtype=ARCHIVE_FIELDS[name], mode="r")
+        return self._maps[name]
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+"""
+    Persistent cache of tokenized texts, shared by all methods using the same tokenizer.
+
+    Token ids of all texts are stored in one flat (ragged) binary file, together with an index mapping
+    the hash of each text to its position in the file. The file is only appended to and memory-mapped for reading.
+    One cache is kept for each combination of tokenizer (identified by its full serialized definition, not just its name),
+    truncation and max_length in the cache_dir, so that repeated runs and different methods (e.g. several detectors
+    based on the roberta tokenizer) tokenize every text only once.
+
+    Texts must be added to a cache by a single process, worker processes forked from it only read from it.
+"""
+
+CACHE_VERSION = 1
+
+TOKEN_DTYPE = np.int32
+
+# open caches of this process, (cache_dir, id of the tokenizer, max_length) -> (tokenizer, cache)
+_CACHES = {}
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_tokenizer_hash(tokenizer) -> str:
+    """Return a hash identifying the tokenizer by its vocabulary, special tokens and pre/post-processing"""
+    if getattr(tokenizer, "is_fast", False):
+        definition = tokenizer.backend_tokenizer.to_str()
+    else:
+        definition = json.dumps(sorted(tokenizer.get_vocab().items()))
+    definition += json.dumps([type(tokenizer).__name__, tokenizer.all_special_tokens, tokenizer.model_input_names])
+    return hashlib.sha1(definition.encode("utf-8")).hexdigest()
+
+
+class TokenizationCache:
+    def __init__(self, cache_dir, tokenizer, max_length=512, truncation=True):
+        key = json.dumps({"version": CACHE_VERSION,
+                          "tokenizer": tokenizer.name_or_path,
+                          "tokenizer_hash": get_tokenizer_hash(tokenizer),
+                          "truncation": truncation,
+                          "max_length": max_length,
+                          "dtype": np.dtype(TOKEN_DTYPE).str},
+                         sort_keys=True)
+        dirname = (tokenizer.name_or_path or type(tokenizer).__name__).replace("/", "-") + "-" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, "tokenized", dirname)
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.truncation = truncation
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, "key.json"), "w") as file:
+                file.write(key)
+
+        self.index = {}
+        self.n_tokens = 0
+        index_path = os.path.join(self.path, "index.jsonl")
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    self.index[entry["hash"]] = (entry["offset"], entry["length"])
+                    self.n_tokens = max(self.n_tokens, entry["offset"] + entry["length"])
+        # drop token ids written by an interrupted add() that did not make it to the index
+        with open(self._ids_path(), "ab") as file:
+            file.truncate(self.n_tokens * np.dtype(TOKEN_DTYPE).itemsize)
+        self._map = None
+
+    def __contains__(self, text):
+        return get_text_hash(text) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, text):
+        """Return the token ids of a cached text as a numpy array or None, if the text is not cached"""
+        entry = self.index.get(get_text_hash(text))
+        if entry is None:
+            return None
+        offset, length = entry
+        return np.array(self._get_map()[offset:offset + length])
+
+    def add(self, texts):
+        """Tokenize the texts that are not cached yet and append their token ids to the cache"""
+        missing = [text for text in dict.fromkeys(texts) if text not in self]
+        if not missing:
+            return
+        input_ids = self.tokenizer(missing, truncation=self.truncation, max_length=self.max_length)["input_ids"]
+        entries = []
+        with open(self._ids_path(), "ab") as file:
+            for text, text_ids in zip(missing, input_ids):
+                file.write(np.asarray(text_ids, dtype=TOKEN_DTYPE).tobytes())
+                self.index[get_text_hash(text)] = (self.n_tokens, len(text_ids))
+                entries.append(json.dumps({"hash": get_text_hash(text), "offset": self.n_tokens, "length": len(text_ids)}))
+                self.n_tokens += len(text_ids)
+        # index is written only after the token ids themselves, so it never points past the end of the file
+        with open(os.path.join(self.path, "index.jsonl"), "a") as index_file:
+            index_file.write("\n".join(entries) + "\n")
+        # file has grown, so it has to be mapped again
+        self._map = None
+
+    def encode(self, texts):
+        """
+        Same as calling the tokenizer on texts without padding (with the truncation and max_length of the cache),
+        but only the texts that are not cached yet are tokenized.
+
+        Returns a dictionary with the input_ids, attention_mask (and token_type_ids, if the tokenizer produces them)
+        lists, which can be padded into batches by tokenizer.pad
+        """
+        self.add(texts)
+        input_ids = [self.get(text).tolist() for text in texts]
+        encoded = {"input_ids": input_ids, "attention_mask": [[1] * len(ids) for ids in input_ids]}
+        if "token_type_ids" in self.tokenizer.model_input_names:
+            encoded["token_type_ids"] = [[0] * len(ids) for ids in input_ids]
+        return encoded
+
+    def _ids_path(self):
+        return os.path.join(self.path, "input_ids.bin")
+
+    def _get_map(self):
+        if self._map is None:
+            if os.path.getsize(self._ids_path()) == 0:
+                # empty files cannot be memory-mapped
+                return np.empty(0, dtype=TOKEN_DTYPE)
+            self._map = np.memmap(self._ids_path(), dtype=TOKEN_DTYPE, mode="r")
+        return self._map
+
+
+def get_tokenization_cache(cache_dir, tokenizer, max_length=512):
+    """Return the tokenization cache of the tokenizer in cache_dir, opened only once per process"""
+    key = (cache_dir, id(tokenizer), max_length)
+    if key not in _CACHES:
+        # the tokenizer is kept referenced, so that its id cannot be reused by another tokenizer
+        _CACHES[key] = (tokenizer, TokenizationCache(cache_dir, tokenizer, max_length))
+    return _CACHES[key][1]
+
+
+def tokenize_texts(tokenizer, texts, config=None, max_length=512):
+    """Tokenize texts without padding (truncated to max_length), through the tokenization cache if enabled in config"""
+    if config is None or not config.get("tokenization_cache", False):
+        return tokenizer(list(texts), truncation=True, max_length=max_length)
+    return get_tokenization_cache(config["cache_dir"], tokenizer, max_length).encode(texts)
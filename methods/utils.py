@@ -2,12 +2,50 @@ import transformers
 import re
 import sys
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score, confusion_matrix
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.svm import SVC
+from sklearn.tree import DecisionTreeClassifier
+from sklearn.ensemble import RandomForestClassifier, AdaBoostClassifier
+from sklearn.neural_network import MLPClassifier
 import time
-from functools import wraps
+import itertools
+from functools import wraps, lru_cache
 import random
+import numpy as np
 import torch
 import torch.nn.functional as F
 import traceback
+from tqdm import tqdm
+
+from methods.compiled_inference import is_compiled, load_pretrained
+from methods.onnx_inference import get_inference_backend
+from methods.parallel import imap_data_parallel
+from methods.tokenization_cache import tokenize_texts
+
+
+CLF_MODELS = {
+    "LogisticRegression": LogisticRegression,
+    "KNeighborsClassifier": KNeighborsClassifier,
+    "SVC": SVC,
+    "DecisionTreeClassifier": DecisionTreeClassifier,
+    "RandomForestClassifier": RandomForestClassifier,
+    "MLPClassifier": MLPClassifier,
+    "AdaBoostClassifier": AdaBoostClassifier
+}
+
+# precisions of models run on CPU (see apply_cpu_precision)
+CPU_PRECISIONS = ("float32", "bfloat16", "int8")
+
+# the fallback from bfloat16 to float32 is reported only once, the precision is looked up for every loaded model and result
+_BF16_FALLBACK_WARNED = False
+
+# rank boundaries (1-indexed, inclusive) of the GLTR top-10, top-100 and top-1000 buckets
+GLTR_BUCKETS = [10, 100, 1000]
+
+# maximal number of logits processed at once by the full-vocabulary computations of get_token_stats, which computes the ranks
+# with get_token_ranks on each of its chunks (64 MB of float32 intermediates, e.g. 333 positions of GPT-2)
+TOKEN_STATS_CHUNK_ELEMENTS = 2 ** 24
 
 def timeit(func):
     @wraps(func)
@@ -88,6 +126,98 @@ def move_tensor_to_device(tensor, DEVICE):
         print(traceback.format_exc(), file=sys.stderr)
         tensor.to(DEFAULT_DEVICE)
 
+def get_cpu_precision(config, DEVICE):
+    """
+    Return the precision (float32, bfloat16 or int8) in which models are run on CPU according to the cpu_precision item of config.
+    Models on other devices, and bfloat16 models on CPUs without native bfloat16 instructions, are kept in float32.
+    """
+    precision = config.get("cpu_precision", "float32") if config is not None else "float32"
+    if "cpu" not in DEVICE:
+        return "float32"
+    if precision not in CPU_PRECISIONS:
+        raise ValueError(f"Unknown CPU precision {precision}, choose one of {', '.join(CPU_PRECISIONS)}")
+    if precision == "bfloat16" and not cpu_supports_bf16():
+        global _BF16_FALLBACK_WARNED
+        if not _BF16_FALLBACK_WARNED:
+            print("WARNING: The CPU does not support bfloat16 natively, running models in float32.")
+            _BF16_FALLBACK_WARNED = True
+        return "float32"
+    return precision
+
+
+def get_model_variant(config, DEVICE):
+    """Return the identifier of the variant in which models are run (e.g. "int8", "float32-compiled" or "onnx"), used to key the model pool"""
+    backend = get_inference_backend(config, DEVICE)
+    if backend != "pytorch":
+        return backend
+    precision = get_cpu_precision(config, DEVICE)
+    return f"{precision}-compiled" if is_compiled(config) else precision
+
+
+@lru_cache(maxsize=None)
+def cpu_supports_bf16():
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            flags = set(file.read().split())
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def apply_cpu_precision(model, config, DEVICE):
+    """
+    Convert a model (already on DEVICE) for inference in the precision given by get_cpu_precision:
+    bfloat16 casts all of its weights, int8 applies dynamic quantization to its Linear layers
+    (including the Conv1D layers of GPT-2 style models, which are converted to Linear layers first).
+
+    Returns the converted model, which must not be trained anymore
+    """
+    precision = get_cpu_precision(config, DEVICE)
+    if precision == "bfloat16":
+        print(f"Converting model {model.__class__.__name__} to bfloat16")
+        return model.to(torch.bfloat16)
+    if precision == "int8":
+        print(f"Quantizing linear layers of model {model.__class__.__name__} to int8")
+        replace_conv1d_with_linear(model)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def replace_conv1d_with_linear(model):
+    """Replace the transformers Conv1D layers (a Linear layer with transposed weights) of a model with equivalent torch Linear layers"""
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if isinstance(child, transformers.pytorch_utils.Conv1D):
+                linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1], device=child.weight.device, dtype=child.weight.dtype)
+                with torch.no_grad():
+                    linear.weight.copy_(child.weight.t())
+                    linear.bias.copy_(child.bias)
+                setattr(parent, name, linear)
+
+
+def reset_peak_memory(DEVICE):
+    """Reset the peak memory counters of this process (resident memory on Linux, allocated memory on CUDA devices)"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+    if "cuda" in str(DEVICE) and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+def get_peak_memory(DEVICE):
+    """Return peak memory usage of this process in GB since the last reset_peak_memory (or since the start of the process)"""
+    peak_memory = {}
+    try:
+        with open("/proc/self/status", "r") as file:
+            peak_memory["ram_gb"] = next(int(line.split()[1]) for line in file if line.startswith("VmHWM")) / 1024 ** 2
+    except (OSError, StopIteration):
+        import resource
+        peak_memory["ram_gb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+    if "cuda" in str(DEVICE) and torch.cuda.is_available():
+        peak_memory["cuda_gb"] = torch.cuda.max_memory_allocated() / 1024 ** 3
+    return peak_memory
+
 def cal_metrics(label, pred_label, pred_posteriors):
     if len(set(label)) < 2:
         acc = accuracy_score(label, pred_label)
@@ -113,88 +243,273 @@ def cal_metrics(label, pred_label, pred_posteriors):
     return acc, precision, recall, f1, auc
 
 
-def get_ll(text, base_model, base_tokenizer, DEVICE):
-    with torch.no_grad():
-        tokenized = base_tokenizer(
-            text, padding=True, truncation=True, max_length=512, return_tensors="pt").to(DEVICE)
-        labels = tokenized.input_ids
-        return -base_model(**tokenized, labels=labels).loss.item()
-        # https://github.com/huggingface/transformers/blob/main/src/transformers/models/gpt2/modeling_gpt2.py#L1317
+def fit_threshold_clf(x_train, y_train, config):
+    """Fit the classification algorithm used for threshold computation (clf_algo_for_threshold in config)"""
+    clf_algo_config = config["clf_algo_for_threshold"]
+    clf_algo_name = clf_algo_config["name"]
+    if CLF_MODELS.get(clf_algo_name) is None:
+        raise ValueError(f"Unsupported classification algorithm for threshold computation selected: {clf_algo_name}")
+    
+    clf_algo = CLF_MODELS[clf_algo_name]
+    clf_model = clf_algo(**{key: value for key, value in clf_algo_config.items() if key != 'name'})
+    return clf_model.fit(x_train, y_train)
+
+
+def get_clf_results(x_train, y_train, x_test, y_test, config):
+
+    clf = fit_threshold_clf(x_train, y_train, config)
+
+    y_train_pred = clf.predict(x_train)
+    y_train_pred_prob = clf.predict_proba(x_train)
+    y_train_pred_prob = [_[1] for _ in y_train_pred_prob]
+    acc_train, precision_train, recall_train, f1_train, auc_train = cal_metrics(
+        y_train, y_train_pred, y_train_pred_prob)
+    train_res = acc_train, precision_train, recall_train, f1_train, auc_train
+
+    y_test_pred = clf.predict(x_test)
+    y_test_pred_prob = clf.predict_proba(x_test)
+    
+    y_test_pred_prob = [_[1] for _ in y_test_pred_prob]
+    acc_test, precision_test, recall_test, f1_test, auc_test = cal_metrics(
+        y_test, y_test_pred, y_test_pred_prob)
+    test_res = acc_test, precision_test, recall_test, f1_test, auc_test
+
+    return y_train_pred, y_test_pred, y_train_pred_prob, y_test_pred_prob, train_res, test_res
+
+
+def load_base_model_and_tokenizer(name, cache_dir, config=None):
+
+    base_model = load_pretrained(transformers.AutoModelForCausalLM, name, config, cache_dir=cache_dir)
+    base_tokenizer = transformers.AutoTokenizer.from_pretrained(
+        name, cache_dir=cache_dir)
+    base_tokenizer.pad_token_id = base_tokenizer.eos_token_id
+    if base_tokenizer.pad_token is None:
+        base_tokenizer.add_special_tokens({'pad_token': '[PAD]'})
+        base_model.resize_token_embeddings(len(base_tokenizer))
+    # get_token_stats expects the valid tokens of a batched text at the beginning of its row
+    base_tokenizer.padding_side = "right"
+
+    return base_model, base_tokenizer
+
+
+def get_token_stats(texts, model, tokenizer, DEVICE, max_length=512, tokenization_cache=None, max_chunk_elements=TOKEN_STATS_CHUNK_ELEMENTS):
+    """
+    Run the base model once over the input text(s) and compute all per-token statistics
+    needed by the metric-based methods. Every statistic is aligned with the predicted tokens,
+    i.e. all tokens of the text except the first one.
+
+    Args:
+        texts (str or list[str]): a single text or a batch of texts
+        model: causal language model
+        tokenizer: tokenizer of the model (padding on the right side)
+        DEVICE (str)
+        max_length (int): number of tokens texts are truncated to
+        tokenization_cache (TokenizationCache): cache of the tokenizer (with the same max_length) to read the token ids from
+        max_chunk_elements (int): maximal number of logits the statistics are computed on at once, so that the full-vocabulary
+            intermediates (log-probabilities, probabilities, comparison masks) never exist for the whole batch
+
+    Returns a list with one dictionary per text, holding the following numpy arrays:
+        ll - log-likelihood of each token
+        rank - 1-indexed rank of each token in the model's likelihood ordering
+        log_rank - natural logarithm of the rank
+        entropy - entropy of the predicted distribution at each position
+        ll_var - variance of the log-likelihood of a token sampled from the predicted distribution at each position
+        gltr - fraction of tokens that fall into the GLTR top-10, top-100, top-1000 and rest buckets
+    """
+    if isinstance(texts, str):
+        texts = [texts]
 
-def get_rank(text, model, tokenizer, DEVICE, log=False):
     with torch.no_grad():
-        tokenized = tokenizer(
-            text, padding=True, truncation=True, max_length=512, return_tensors="pt").to(DEVICE)
+        if tokenization_cache is not None:
+            tokenized = tokenizer.pad(tokenization_cache.encode(texts), return_tensors="pt").to(DEVICE)
+        else:
+            tokenized = tokenizer(
+                texts, padding=True, truncation=True, max_length=max_length, return_tensors="pt").to(DEVICE)
         logits = model(**tokenized).logits[:, :-1]
         labels = tokenized.input_ids[:, 1:]
+        valid = tokenized.attention_mask[:, 1:].bool()
+
+        ll = torch.empty(labels.shape, device=logits.device)
+        entropy = torch.empty(labels.shape, device=logits.device)
+        ll_var = torch.empty(labels.shape, device=logits.device)
+        ranks = torch.empty(labels.shape, dtype=torch.long, device=logits.device)
+        for index in get_logits_chunks(logits.shape, max_chunk_elements):
+            chunk_logits = logits[index].float()
+            chunk_labels = labels[index].unsqueeze(-1)
+            ranks[index] = get_token_ranks(chunk_logits, labels[index], max_chunk_elements)
+            log_probs = F.log_softmax(chunk_logits, dim=-1)
+            del chunk_logits
+            ll[index] = log_probs.gather(-1, chunk_labels).squeeze(-1)
+            # p * log(p) and p * log(p)^2 are computed in place in the buffer of the probabilities
+            weighted = log_probs.exp().mul_(log_probs)
+            entropy[index] = -weighted.sum(-1)
+            ll_var[index] = weighted.mul_(log_probs).sum(-1) - entropy[index].square()
+            del log_probs, weighted
+        del logits
+
+    return [make_token_stats(ll=ll[idx][valid[idx]].cpu().numpy(),
+                             rank=ranks[idx][valid[idx]].cpu().numpy(),
+                             entropy=entropy[idx][valid[idx]].cpu().numpy(),
+                             ll_var=ll_var[idx][valid[idx]].cpu().numpy())
+            for idx in range(len(texts))]
+
+
+def make_token_stats(ll, rank, entropy, ll_var):
+    """Complete the per-token statistics of a single text (see get_token_stats) with the derived statistics"""
+    return {
+        "ll": ll,
+        "rank": rank,
+        "log_rank": np.log(rank),
+        "entropy": entropy,
+        "ll_var": ll_var,
+        "gltr": get_gltr_buckets(rank),
+    }
 
-        # get rank of each label token in the model's likelihood ordering
-        matches = (logits.argsort(-1, descending=True)
-                == labels.unsqueeze(-1)).nonzero()
-        assert matches.shape[
-            1] == 3, f"Expected 3 dimensions in matches tensor, got {matches.shape}"
 
-        ranks, timesteps = matches[:, -1], matches[:, -2]
+def get_token_ranks(logits, labels, max_chunk_elements=TOKEN_STATS_CHUNK_ELEMENTS):
+    """
+    Get the 1-indexed rank of each label token in the model's likelihood ordering
+    by counting the logits that are strictly greater than the logit of the label token.
+    Unlike sorting the whole vocabulary, this needs only a boolean comparison mask, which is built
+    for chunks of at most max_chunk_elements logits at a time.
+
+    Args:
+        logits (torch.Tensor): logits of shape (..., vocab_size)
+        labels (torch.Tensor): token ids of shape (...)
+
+    Returns a tensor of ranks with the same shape as labels
+    """
+    ranks = torch.empty(labels.shape, dtype=torch.long, device=logits.device)
+    for index in get_logits_chunks(logits.shape, max_chunk_elements):
+        chunk_logits = logits[index]
+        ranks[index] = (chunk_logits > chunk_logits.gather(-1, labels[index].unsqueeze(-1))).sum(-1) + 1
+    return ranks
+
+
+def get_logits_chunks(shape, max_chunk_elements=TOKEN_STATS_CHUNK_ELEMENTS):
+    """
+    Split logits of the given shape (..., n_positions, vocab_size) into chunks of positions of at most max_chunk_elements logits
+    (but at least one position). Chunks are views into the logits, so no copy of them is made.
+
+    Returns a list of indices (tuples of ints and a slice of positions) of the chunks
+    """
+    *leading, n_positions, vocab_size = shape
+    chunk_length = max(1, max_chunk_elements // max(vocab_size, 1))
+    return [(*outer, slice(start, start + chunk_length))
+            for outer in itertools.product(*(range(size) for size in leading))
+            for start in range(0, n_positions, chunk_length)]
+
+
+def get_length_sorted_batches(texts, batch_size):
+    """
+    Split texts into batches of similar length to minimize the padding inside each batch.
+    Character length is used as a cheap proxy for the number of tokens.
+
+    Args:
+        texts (list[str])
+        batch_size (int): maximal number of texts in a batch
+
+    Returns a list of batches, each batch being a list of indices into texts
+    """
+    order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def get_token_budget_batches(lengths, max_tokens):
+    """
+    Split items into batches of similar length, each filled up to a budget of max_tokens tokens
+    including the padding (i.e. number of items in the batch times the length of the longest one).
+
+    Args:
+        lengths (list[int]): number of tokens of each item
+        max_tokens (int): token budget of a batch, an item longer than the budget gets a batch of its own
+
+    Returns a list of batches, each batch being a list of indices into lengths
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+    batches = []
+    batch = []
+    for idx in order:
+        # items are sorted by length, so the batch is padded to the length of the item being added
+        if batch and (len(batch) + 1) * lengths[idx] > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_classifier_predictions(model, tokenizer, texts, output_fn, DEVICE, max_tokens, config=None, desc="Evaluating", max_length=512):
+    """
+    Run a sequence classification model over texts in length-sorted batches filled up to a token budget
+    (see get_token_budget_batches), so that short texts are not padded to the length of long ones.
+    Texts are tokenized only once (through the tokenization cache if enabled in config), batches are padded to their longest text.
+
+    Args:
+        output_fn (callable): function mapping the logits of a batch to a list of predictions (one per text)
+        max_tokens (int): token budget of a batch (including padding)
+        config (dict): method config, batches are processed by worker processes if enabled in it (see methods/parallel.py)
+
+    Returns a list of predictions in the order of texts
+    """
+    if len(texts) == 0:
+        return []
+    tokenized = tokenize_texts(tokenizer, texts, config, max_length)
+    batches = get_token_budget_batches([len(input_ids) for input_ids in tokenized["input_ids"]], max_tokens)
+
+    def predict(batch):
+        inputs = tokenizer.pad({key: [values[idx] for idx in batch] for key, values in tokenized.items()},
+                               return_tensors="pt").to(DEVICE)
+        return output_fn(model(**inputs).logits)
+
+    preds = [None] * len(texts)
+    with torch.no_grad():
+        for batch, batch_preds in zip(batches, tqdm(imap_data_parallel(predict, batches, config, DEVICE), total=len(batches), desc=desc)):
+            for idx, pred in zip(batch, batch_preds):
+                preds[idx] = pred
+    return preds
 
-        # make sure we got exactly one match for each timestep in the sequence
-        assert (timesteps == torch.arange(len(timesteps)).to(
-            timesteps.device)).all(), "Expected one match per timestep"
 
-        ranks = ranks.float() + 1  # convert to 1-indexed rank
-        if log:
-            ranks = torch.log(ranks)
+def get_max_batch_tokens(config, batch_size, max_length=512):
+    """Return the token budget of a batch of supervised inference, by default that of batch_size texts of max_length tokens"""
+    max_batch_tokens = config.get("max_batch_tokens") if config is not None else None
+    return max_batch_tokens or batch_size * max_length
 
-        return ranks.float().mean().item()
 
-def get_entropy(text, model, tokenizer, DEVICE):
-    with torch.no_grad():
-        tokenized = tokenizer(
-            text, padding=True, truncation=True, max_length=512, return_tensors="pt").to(DEVICE)
-        logits = model(**tokenized).logits[:, :-1]
-        neg_entropy = F.softmax(logits, dim=-1) * F.log_softmax(logits, dim=-1)
-        return -neg_entropy.sum(-1).mean().item()
+def get_gltr_buckets(ranks):
+    """
+    Count the fraction of tokens falling into each of the GLTR buckets (see GLTR_BUCKETS).
 
-def get_llm_deviation(text, model, tokenizer, DEVICE):
-    with torch.no_grad():
-        tokenized = tokenizer(
-            text, padding=True, truncation=True, max_length=512, return_tensors="pt").to(DEVICE)
-        logits = model(**tokenized).logits[:, :-1]
-        labels = tokenized.input_ids[:, 1:]
+    Args:
+        ranks (np.ndarray): 1-indexed token ranks
+    
+    Returns a numpy array of 4 fractions (or zeros for an empty input)
+    """
+    counts = np.bincount(np.searchsorted(GLTR_BUCKETS, ranks), minlength=len(GLTR_BUCKETS) + 1).astype(float)
+    if counts.sum() > 0:
+        counts = counts / counts.sum()
+    return counts
 
-        # get rank of each label token in the model's likelihood ordering
-        matches = (logits.argsort(-1, descending=True)
-                == labels.unsqueeze(-1)).nonzero()
-        assert matches.shape[
-            1] == 3, f"Expected 3 dimensions in matches tensor, got {matches.shape}"
 
-        ranks, timesteps = matches[:, -1], matches[:, -2]
+def get_ll(text, base_model, base_tokenizer, DEVICE):
+    return get_token_stats(text, base_model, base_tokenizer, DEVICE)[0]["ll"].mean().item()
 
-        # make sure we got exactly one match for each timestep in the sequence
-        assert (timesteps == torch.arange(len(timesteps)).to(
-            timesteps.device)).all(), "Expected one match per timestep"
+def get_rank(text, model, tokenizer, DEVICE, log=False):
+    stats = get_token_stats(text, model, tokenizer, DEVICE)[0]
+    return (stats["log_rank"] if log else stats["rank"]).mean().item()
 
-        ranks = ranks.float() + 1  # convert to 1-indexed rank
-        
-        ranks = torch.log(ranks)
-        ranks = torch.square(ranks)
+def get_entropy(text, model, tokenizer, DEVICE):
+    return get_token_stats(text, model, tokenizer, DEVICE)[0]["entropy"].mean().item()
 
-        return ranks.float().mean().item()
+def get_llm_deviation(text, model, tokenizer, DEVICE):
+    return llm_deviation_from_stats(get_token_stats(text, model, tokenizer, DEVICE)[0])
 
 def get_s5(text, model, tokenizer, DEVICE):
-    with torch.no_grad():
-        tokenized = tokenizer(
-            text, padding=True, truncation=True, max_length=512, return_tensors="pt").to(DEVICE)
-        labels = tokenized.input_ids
-        outputs = model(**tokenized, labels=labels)
-        logits = outputs.logits[:, :-1]
+    return s5_from_stats(get_token_stats(text, model, tokenizer, DEVICE)[0])
 
-        neg_entropy = F.softmax(logits, dim=-1) * F.log_softmax(logits, dim=-1)
-
-        labels = tokenized.input_ids[:, 1:]
-        matches = (logits.argsort(-1, descending=True) == labels.unsqueeze(-1)).nonzero()
-        assert matches.shape[1] == 3, f"Expected 3 dimensions in matches tensor, got {matches.shape}"
-        ranks, timesteps = matches[:, -1], matches[:, -2]
-        assert (timesteps == torch.arange(len(timesteps)).to(timesteps.device)).all(), "Expected one match per timestep"
-        ranks = ranks.float() + 1  # convert to 1-indexed rank
+def llm_deviation_from_stats(stats):
+    return np.square(stats["log_rank"]).mean().item()
 
-        return [-outputs.loss.item(), -neg_entropy.sum(-1).mean().item(), ranks.float().mean().item(), torch.log(ranks).float().mean().item(), torch.square(torch.log(ranks)).float().mean().item()]
+def s5_from_stats(stats):
+    return [stats["ll"].mean().item(), stats["entropy"].mean().item(), stats["rank"].mean().item(), stats["log_rank"].mean().item(), llm_deviation_from_stats(stats)]
@@ -171,6 +171,57 @@ def analyze_running_time_over_multiple_datasets(results_list, save_path: str, is
   plt.savefig(os.path.join(save_path, "running_time_over_multiple_datasets.png"), dpi=600)
   if is_interactive:
     plt.show()
+
+
+def analyze_cpu_precision(results_list, save_path: str, is_interactive: bool) -> None:
+  """
+  Compare test accuracy, F1 score and throughput of detectors run in reduced CPU precision (bfloat16, int8), compiled
+  or by ONNX Runtime with the same detectors run in float32 by PyTorch without compilation. This function requires each experiment in the results list
+  to have a 'running_time_seconds' item and the other modes also a 'cpu_precision', 'compiled' or 'inference_backend' item in its benchmark results.
+  """
+  for dataset_name, dataset_results in results_list.items():
+    results = pd.DataFrame()
+    for detector in dataset_results.values():
+      mode = detector.get("cpu_precision", "float32") + (", compiled" if detector.get("compiled", False) else "")
+      if detector.get("inference_backend", "pytorch") != "pytorch":
+        mode = detector["inference_backend"]
+      n_texts = len(detector["input_data"]["train"]["text"]) + len(detector["input_data"]["test"]["text"])
+      results = pd.concat([results, pd.DataFrame({'Detector': detector["name"].removesuffix(f" ({mode})"),
+                                                  'Mode': mode,
+                                                  'Accuracy': detector["metrics_results"]["test"]["acc"],
+                                                  'F1-score': detector["metrics_results"]["test"]["f1"],
+                                                  'TextsPerSecond': n_texts / detector["running_time_seconds"]}, index=[0])], copy=False, ignore_index=True)
+    if results.empty or (results["Mode"] == "float32").all():
+      print(f"No results in reduced CPU precision or compiled on {dataset_name} dataset, skipping the precision comparison")
+      continue
+    
+    baseline = results[results["Mode"] == "float32"].drop_duplicates("Detector").set_index("Detector")
+    results = results[results["Detector"].isin(baseline.index)].copy()
+    results["Speedup"] = results["TextsPerSecond"] / results["Detector"].map(baseline["TextsPerSecond"])
+    results["AccuracyDifference"] = results["Accuracy"] - results["Detector"].map(baseline["Accuracy"])
+    results["F1-scoreDifference"] = results["F1-score"] - results["Detector"].map(baseline["F1-score"])
+    print(f"CPU precision comparison on {dataset_name} dataset:\n{results.to_string(index=False)}")
+    results.to_csv(os.path.join(save_path, f"{dataset_name}_cpu_precision_comparison.csv"), index=False)
+
+    fig = plt.figure(figsize=(10, 10))
+    fig.suptitle(f"{dataset_name} dataset", fontsize=16)
+    
+    rows, cols = 1, 2
+    
+    fig.add_subplot(rows, cols, 1)
+    ax = sns.barplot(results, x="Detector", y="Speedup", hue="Mode")
+    ax.set(title="Throughput relative to float32")
+    plt.xticks(rotation=25, ha="right")
+    
+    fig.add_subplot(rows, cols, 2)
+    ax = sns.barplot(results, x="Detector", y="F1-score", hue="Mode")
+    ax.set(ylim=(0,1), title="Test F1 score")
+    plt.xticks(rotation=25, ha="right")
+
+    fig.tight_layout()
+    plt.savefig(os.path.join(save_path, f"{dataset_name}_cpu_precision_comparison_analysis.png"))
+    if is_interactive:
+      plt.show()
       
 
 def analyze_text_lengths(results_list, save_path, is_interactive: bool):
@@ -432,6 +483,7 @@ def list_available_analysis_methods():
   print("analyze_false_negatives  ...   Analyze false negative rates")
   print("analyze_running_time     ...   Analyze per-method per-dataset running time")
   print("analyze_running_time_over_multiple_datasets  ... Analyze per-method running time over multiple datasets")
+  print("analyze_cpu_precision    ...   Compare accuracy and throughput of methods run in reduced CPU precision (bfloat16, int8) or compiled with float32")
 
 def make_method_names_unique(results):
   for _, dataset in results.items():
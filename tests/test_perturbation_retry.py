@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from methods.abstract_methods import pertubation_based_experiment as pbe
+
+ARGS = {"span_length": 2, "buffer_size": 1, "pct_words_masked": 0.3, "mask_top_p": 1.0, "chunk_size": 4, "random_fills": False}
+
+
+class FakeMaskFilling:
+    """Replacement of replace_masks, which records the size of each generate call and fails to fill some texts"""
+    def __init__(self, failures):
+        self.failures = failures  # text -> number of attempts failing to fill it
+        self.batch_sizes = []
+
+    def __call__(self, masked_texts, mask_model, mask_tokenizer, mask_top_p, DEVICE, span_length=2):
+        self.batch_sizes.append(len(masked_texts))
+        raw_fills = []
+        for text, n_masks in zip(masked_texts, pbe.count_masks(masked_texts)):
+            original = text.split(" ")[0]
+            n_fills = n_masks
+            if self.failures.get(original, 0) > 0:
+                self.failures[original] -= 1
+                n_fills = 0
+            raw_fills.append("<pad>" + "".join(f"<extra_id_{idx}> fill" for idx in range(n_fills)) + f"<extra_id_{n_fills}>")
+        return raw_fills
+
+
+def get_texts(n):
+    # texts start with a unique word, which is never masked, so the fake mask filling can recognize them
+    return [f"text{idx} " + " ".join(["word"] * (20 + idx)) for idx in range(n)]
+
+
+def run_perturbation(monkeypatch, texts, failures):
+    fake = FakeMaskFilling({text.split(" ")[0]: count for text, count in failures.items()})
+    monkeypatch.setattr(pbe, "replace_masks", fake)
+    monkeypatch.setattr(pbe, "sample_mask_spans", lambda n_tokens, span_length, buffer_size, n_spans: [range(2, 2 + count * 4, 4) for count in n_spans])
+    completed = []
+    outputs = pbe.perturb_texts(ARGS, texts, None, None, None, callback=lambda chunk, chunk_outputs: completed.extend(chunk))
+    return fake, outputs, completed
+
+
+def test_failed_texts_are_retried_together(monkeypatch):
+    texts = get_texts(10)
+    # one failed text in each of the three chunks
+    fake, outputs, completed = run_perturbation(monkeypatch, texts, {texts[0]: 1, texts[5]: 1, texts[9]: 1})
+    assert fake.batch_sizes == [4, 4, 2, 3]
+    assert all(output and "<extra_id_" not in output for output in outputs)
+    assert sorted(completed) == list(range(10))
+
+
+def test_failed_texts_fill_full_batches(monkeypatch):
+    texts = get_texts(12)
+    # the four failed texts of the first chunk are filled again in a full batch right after it,
+    # the rest after the last chunk, the twice failing text once more on its own
+    fake, outputs, _ = run_perturbation(monkeypatch, texts, {texts[idx]: 1 for idx in range(5)} | {texts[6]: 2})
+    assert fake.batch_sizes == [4, 4, 4, 4, 2, 1]
+    assert sum(fake.batch_sizes) == len(texts) + 5 + 2
+    assert all(output and "<extra_id_" not in output for output in outputs)
+
+
+def test_mask_spans_do_not_overlap():
+    n_tokens, n_spans = [3, 10, 20, 60, 512], [1, 5, 3, 100, 50]
+    span_length, buffer_size = 2, 1
+    for length, count, starts in zip(n_tokens, n_spans, pbe.sample_mask_spans(n_tokens, span_length, buffer_size, n_spans)):
+        assert len(starts) <= count
+        assert all(0 <= start <= length - span_length - 1 for start in starts)
+        assert all(gap >= span_length + buffer_size for gap in starts[1:] - starts[:-1])
+    # texts too short for the requested spans get as many as fit
+    assert [len(starts) for starts in pbe.sample_mask_spans([10, 60], span_length, buffer_size, [5, 100])] == [3, 20]
+
+
+@pytest.mark.parametrize("n_words", [3, 5, 1000])
+def test_fill_words_are_distinct_within_a_span(monkeypatch, n_words):
+    monkeypatch.setattr(pbe, "FILL_DICTIONARY", pbe.get_fill_dictionary([" ".join(f"w{idx}" for idx in range(n_words))]))
+    words = pbe.sample_fill_words(500, 3)
+    assert words.shape == (500, 3)
+    assert all(len(set(span_words)) == 3 for span_words in words)
+    with pytest.raises(ValueError):
+        pbe.sample_fill_words(1, n_words + 1)
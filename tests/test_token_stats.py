@@ -0,0 +1,130 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import numpy as np
+from methods.utils import get_token_ranks, get_gltr_buckets
+
+
+def argsort_ranks(logits, labels):
+    """Reference implementation of the rank computation through sorting of the whole vocabulary"""
+    matches = (logits.argsort(-1, descending=True) == labels.unsqueeze(-1)).nonzero()
+    ranks = torch.empty_like(labels)
+    ranks[matches[:, 0], matches[:, 1]] = matches[:, 2]
+    return ranks + 1
+
+
+def loop_gltr_buckets(ranks):
+    """Reference implementation of the GLTR bucketing on 0-indexed ranks"""
+    res = np.array([0.0, 0.0, 0.0, 0.0])
+    for rank in ranks:
+        if rank < 10:
+            res[0] += 1
+        elif rank < 100:
+            res[1] += 1
+        elif rank < 1000:
+            res[2] += 1
+        else:
+            res[3] += 1
+    if res.sum() > 0:
+        res = res / res.sum()
+    return res
+
+
+def test_rank_kernel_parity():
+    torch.manual_seed(0)
+    logits = torch.randn(3, 64, 5000)
+    labels = torch.randint(0, 5000, (3, 64))
+    assert torch.equal(get_token_ranks(logits, labels), argsort_ranks(logits, labels))
+
+
+def test_rank_kernel_top_token():
+    logits = torch.tensor([[[0.1, 3.0, 2.0, -1.0]]])
+    assert get_token_ranks(logits, torch.tensor([[1]])).item() == 1
+    assert get_token_ranks(logits, torch.tensor([[3]])).item() == 4
+
+
+def test_gltr_buckets_parity():
+    rng = np.random.default_rng(0)
+    ranks = np.concatenate([np.arange(1, 1200), rng.integers(1, 50000, 500)])
+    assert np.allclose(get_gltr_buckets(ranks), loop_gltr_buckets(ranks - 1))
+    assert np.allclose(get_gltr_buckets(np.array([], dtype=int)), loop_gltr_buckets([]))
+
+
+def test_rank_kernel_chunked():
+    torch.manual_seed(0)
+    logits = torch.randn(2, 50, 1000)
+    labels = torch.randint(0, 1000, (2, 50))
+    # chunks of 7 positions, which do not divide the number of positions
+    assert torch.equal(get_token_ranks(logits, labels, max_chunk_elements=7000), argsort_ranks(logits, labels))
+    # chunks smaller than a single position still hold one position
+    assert torch.equal(get_token_ranks(logits, labels, max_chunk_elements=10), argsort_ranks(logits, labels))
+
+
+def get_tiny_model_and_tokenizer():
+    """Randomly initialized GPT-2 of a few thousand parameters with a word-level tokenizer, so that no download is needed"""
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Tokenizer, models, pre_tokenizers
+
+    vocab = {"<eos>": 0, "<unk>": 1, **{f"w{idx}": idx + 2 for idx in range(200)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>", unk_token="<unk>", pad_token="<eos>")
+    tokenizer.padding_side = "right"
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=len(vocab), n_positions=64, n_embd=16, n_layer=1, n_head=2)
+    return transformers.GPT2LMHeadModel(config).eval(), tokenizer
+
+
+def reference_token_stats(text, model, tokenizer):
+    """Reference implementation of the statistics of a single text on the whole vocabulary at once"""
+    input_ids = tokenizer(text, return_tensors="pt").input_ids
+    with torch.no_grad():
+        log_probs = torch.log_softmax(model(input_ids).logits[0, :-1].float(), dim=-1)
+    labels = input_ids[0, 1:]
+    probs = log_probs.exp()
+    entropy = -(probs * log_probs).sum(-1)
+    return {
+        "ll": log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1).numpy(),
+        "rank": argsort_ranks(log_probs.unsqueeze(0), labels.unsqueeze(0))[0].numpy(),
+        "entropy": entropy.numpy(),
+        "ll_var": ((probs * log_probs.square()).sum(-1) - entropy.square()).numpy(),
+    }
+
+
+@pytest.mark.parametrize("max_chunk_elements", [1, 202 * 5, 2 ** 24])
+def test_token_stats_chunked_parity(max_chunk_elements):
+    from methods.utils import get_token_stats
+
+    model, tokenizer = get_tiny_model_and_tokenizer()
+    texts = ["w1 w2 w3 w4 w5 w6 w7 w8 w9 w10 w11 w12", "w5 w7 w9", "w100 w150 w3 w3 w3 w42 w199"]
+    for stats, text in zip(get_token_stats(texts, model, tokenizer, "cpu", max_chunk_elements=max_chunk_elements), texts):
+        reference = reference_token_stats(text, model, tokenizer)
+        assert np.array_equal(stats["rank"], reference["rank"])
+        for name in ["ll", "entropy", "ll_var"]:
+            assert np.allclose(stats[name], reference[name], atol=1e-5), name
+
+
+def test_token_stats_memory_is_bounded(monkeypatch):
+    """The full-vocabulary intermediates are computed only on chunks of at most max_chunk_elements logits"""
+    import methods.utils as utils
+
+    model, tokenizer = get_tiny_model_and_tokenizer()
+    sizes = []
+    log_softmax = utils.F.log_softmax
+    def recording_log_softmax(input, *args, **kwargs):
+        sizes.append(input.numel())
+        return log_softmax(input, *args, **kwargs)
+    monkeypatch.setattr(utils.F, "log_softmax", recording_log_softmax)
+    # the ranks are computed by the tested rank kernel on the same chunks
+    rank_sizes = []
+    get_token_ranks = utils.get_token_ranks
+    def recording_get_token_ranks(logits, *args, **kwargs):
+        rank_sizes.append(logits.numel())
+        return get_token_ranks(logits, *args, **kwargs)
+    monkeypatch.setattr(utils, "get_token_ranks", recording_get_token_ranks)
+
+    texts = [" ".join(f"w{idx}" for idx in range(length)) for length in (40, 30, 20, 10)]
+    utils.get_token_stats(texts, model, tokenizer, "cpu", max_chunk_elements=202 * 8)
+    assert sizes and max(sizes) <= 202 * 8
+    assert rank_sizes == sizes